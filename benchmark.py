@@ -0,0 +1,411 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------------------------
+# benchmark.py - Benchmark the DATEV exporters on synthetic InBehandlung backup files
+#
+# Syntax: benchmark.py [-p <number of payments> ...] [-e dict|pandas|all] [-d <directory>]
+#
+# License: MIT License
+#-------------------------------------------------------------------------------------------------
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Frank Blankenburg
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial
+# portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#-------------------------------------------------------------------------------------------------
+
+import argparse
+import array
+import csv
+import io
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import sys
+import tempfile
+import time
+import warnings
+import zipfile
+
+#---------------------------------------------------------------------
+# Configuration
+#---------------------------------------------------------------------
+
+#
+# First month of the generated backup data and number of months covered
+#
+first_year   = 2012
+period       = 60
+
+#
+# Tax table of the generated backups as (id, tax rate) pairs
+#
+taxes = [('1', '19.00'), ('2', '7.00'), ('3', '0.00')]
+
+#
+# Non-invoice payment types of the generated backups
+#
+expenses = ['Geld auf Bank', 'Büromaterial', 'Porto', 'Reinigung']
+
+
+#---------------------------------------------------------------------
+# Synthetic backup generator
+#---------------------------------------------------------------------
+
+#
+# Round into full euro and cents
+#
+def roundEuro (n):
+    return round (100.0 * n + 0.0001) / 100.0
+
+#
+# Return random date string within a month of the generated period
+#
+def randomDate (month):
+    return '{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}'.format (first_year + month // 12, month % 12 + 1,
+                                                               random.randint (1, 28), random.randint (8, 19),
+                                                               random.randint (0, 59), random.randint (0, 59))
+
+#
+# Write a single CSV table into the backup ZIP file
+#
+# @param archive ZIP file opened for writing
+# @param name    Name of the table
+# @param header  List of column names
+# @param rows    Iterable of rows. 'None' cells are written as 'NULL'.
+#
+def writeTable (archive, name, header, rows):
+    with archive.open ('backup/{}.csv'.format (name), 'w') as file:
+        with io.TextIOWrapper (file, 'utf-8', newline='') as text:
+            writer = csv.writer (text, delimiter=',', quotechar='\"')
+            writer.writerow (header)
+
+            for row in rows:
+                writer.writerow (['NULL' if cell is None else cell for cell in row])
+
+#
+# Generate synthetic InBehandlung backup ZIP file
+#
+# The backup contains invoices with product, medication and service line items,
+# payments of these invoices (including partial payments, cancellations and
+# overpayments), non-invoice cash payments and an unused appointments table.
+#
+# @param filename Name of the backup ZIP file to be written
+# @param payments Approximate number of payments in the backup
+# @param seed     Random generator seed
+#
+def generateBackup (filename, payments, seed=0):
+    random.seed (seed)
+
+    invoices = max (1, int (payments / 1.4))
+    clients  = max (1, invoices // 10)
+
+    #
+    # Invoice totals and months accumulated while writing the line items
+    #
+    totals = array.array ('d', [0.0] * invoices)
+    months = array.array ('l', [random.randrange (period) for i in range (invoices)])
+
+    def lineItems (columns, count, applied=False):
+        id = 0
+
+        for invoice in range (invoices):
+            for i in range (random.randint (0, count)):
+                id += 1
+                price  = round (random.uniform (1.0, 80.0), 2)
+                amount = random.choice ([1, 1, 2, 0.5, 1.5])
+                factor = random.choice ([1.0, 1.0, 1.8, 2.3])
+                number = random.randint (1, 3)
+
+                row = {'amount': amount, 'factor': factor, 'count': number}
+                value = price
+
+                for key in columns:
+                    value *= row[key]
+
+                totals[invoice] += roundEuro (value)
+
+                yield ([id, invoice + 1, random.choice (['1', '2', '3']), '{:.2f}'.format (price)] +
+                       [row[key] for key in columns] +
+                       ([random.choice (['0', '1'])] if applied else []) +
+                       ['Artikel {}'.format (id % 1000)])
+
+    with zipfile.ZipFile (filename, 'w', zipfile.ZIP_DEFLATED) as archive:
+
+        writeTable (archive, 'tax', ['id', 'tax', 'name'],
+                    ([id, tax, 'MwSt {}'.format (tax)] for id, tax in taxes))
+
+        writeTable (archive, 'clients', ['id', 'firstname', 'lastname', 'street', 'city'],
+                    ([id, 'Vorname {}'.format (id), 'Name {}'.format (id), 'Strasse {}'.format (id % 100), 'Stadt']
+                     for id in range (1, clients + 1)))
+
+        writeTable (archive, 'invoice_product',
+                    ['id', 'invoice_id', 'tax_id', 'price', 'amount', 'description'],
+                    lineItems (['amount'], 2))
+
+        writeTable (archive, 'invoice_medication',
+                    ['id', 'invoice_id', 'tax_id', 'price', 'amount', 'applied', 'description'],
+                    lineItems (['amount'], 2, applied=True))
+
+        writeTable (archive, 'invoice_service',
+                    ['id', 'invoice_id', 'tax_id', 'price', 'factor', 'count', 'description'],
+                    lineItems (['factor', 'count'], 3))
+
+        for invoice in range (invoices):
+            totals[invoice] = roundEuro (totals[invoice])
+
+        status = [random.choice (['complete'] * 19 + ['draft']) for invoice in range (invoices)]
+
+        writeTable (archive, 'invoices',
+                    ['id', 'number', 'client_id', 'date', 'total', 'status', 'notes'],
+                    ([invoice + 1, 'R{:07d}'.format (invoice + 1), random.randint (1, clients),
+                      randomDate (months[invoice]), '{:.2f}'.format (totals[invoice]), status[invoice], None]
+                     for invoice in range (invoices)))
+
+        def paymentRows ():
+            id = 0
+
+            for invoice in range (invoices):
+                if status[invoice] != 'complete':
+                    continue
+
+                open = totals[invoice]
+                parts = random.choice ([1, 1, 1, 2, 3])
+
+                for part in range (parts):
+                    amount = open if part == parts - 1 else roundEuro (open * random.uniform (0.2, 0.7))
+
+                    if random.random () < 0.01:
+                        amount = roundEuro (amount + 5.0)
+
+                    open = roundEuro (open - amount)
+                    month = min (months[invoice] + part, period - 1)
+
+                    id += 1
+                    yield [id, invoice + 1, '{:.2f}'.format (amount), randomDate (month),
+                           random.choice (['cash', 'cash', 'ec', 'bill']), 'Rechnung', None,
+                           'user{}'.format (random.randint (1, 4)),
+                           '2015-01-01 00:00:00' if random.random () < 0.02 else None]
+
+                if random.random () < 0.05:
+                    id += 1
+                    kind = random.choice (expenses)
+                    yield [id, None, '{:.2f}'.format (-round (random.uniform (5.0, 500.0), 2)),
+                           randomDate (random.randrange (period)), 'cash', kind, 'Beleg {}'.format (id),
+                           'user1', None]
+
+        writeTable (archive, 'payments',
+                    ['id', 'invoice_id', 'amount', 'date', 'method', 'paymenttype', 'notes', 'username', 'deleted'],
+                    paymentRows ())
+
+        writeTable (archive, 'appointments', ['id', 'client_id', 'start', 'end', 'notes'],
+                    ([id, random.randint (1, clients), randomDate (id % period), randomDate (id % period), 'Termin']
+                     for id in range (1, invoices + 1)))
+
+
+#---------------------------------------------------------------------
+# Benchmarks
+#---------------------------------------------------------------------
+
+#
+# Return peak resident set size of the current process in MB
+#
+def peakMemory ():
+    usage = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+    return usage / (1024.0 * 1024.0) if sys.platform == 'darwin' else usage / 1024.0
+
+#
+# Measure the stages of the dictionary based engine (datevexport.py). The
+# invoice stage includes replaying the payments before the exported month.
+#
+# @param filename     Name of the backup ZIP file
+# @param export_month Month key of the exported month
+# @return List of (stage, seconds) pairs and number of DATEV rows
+#
+def benchmarkDict (filename, export_month):
+    import datevexport
+
+    stages = []
+    start = time.perf_counter ()
+
+    def stage (name):
+        nonlocal start
+        now = time.perf_counter ()
+        stages.append ((name, now - start))
+        start = now
+
+    year, month = datevexport.keyToMonth (export_month)
+
+    database = datevexport.loadBackup (filename)
+    stage ('load')
+
+    invoices = datevexport.createInvoices (database, year, month)
+    stage ('invoices')
+
+    datev = datevexport.createEntries (database, invoices, year, month)
+    stage ('allocation')
+
+    rows = [entry.toDatev () for entry in datev]
+    stage ('format')
+
+    with tempfile.TemporaryDirectory () as directory:
+        datevexport.writeRows (os.path.join (directory, 'datev.csv'), datevexport.datev_columns, rows)
+    stage ('write')
+
+    return stages, len (rows)
+
+#
+# Measure the stages of the pandas based engine (datevexport_pandas.py)
+#
+# @param filename     Name of the backup ZIP file
+# @param export_month Month key of the exported month
+# @return List of (stage, seconds) pairs and number of DATEV rows
+#
+def benchmarkPandas (filename, export_month):
+    import datevexport
+    import datevexport_pandas
+
+    stages = []
+    start = time.perf_counter ()
+
+    def stage (name):
+        nonlocal start
+        now = time.perf_counter ()
+        stages.append ((name, now - start))
+        start = now
+
+    tables = datevexport_pandas.loadBackup (filename)
+    stage ('load')
+
+    debt = datevexport_pandas.computeDebt (tables)
+    stage ('invoices')
+
+    year, month = datevexport.keyToMonth (export_month)
+    rows, crosscheck, turnover, petty_cash = datevexport_pandas.exportMonth (tables, year, month, debt)
+    stage ('allocation+format')
+
+    with tempfile.TemporaryFile ('w', newline='') as file:
+        rows.to_csv (file, sep=';', quoting=csv.QUOTE_ALL, quotechar='"', header=datevexport.datev_columns,
+                     index=False, lineterminator='\r\n')
+    stage ('write')
+
+    return stages, len (rows)
+
+#
+# Benchmark entry point executed in a separate process, so that the peak memory
+# of each engine is measured independently
+#
+def runBenchmark (engine, filename, export_month, results):
+    warnings.simplefilter ('ignore')
+
+    benchmark = benchmarkDict if engine == 'dict' else benchmarkPandas
+    stages, rows = benchmark (filename, export_month)
+
+    results.put ((stages, rows, peakMemory ()))
+
+#
+# Wait for the result of a benchmark process
+#
+# @param process Started benchmark process
+# @param results Queue the process puts its result into
+# @return Result as put by 'runBenchmark ()' or 'None' if the process died without result
+#
+def waitForResult (process, results):
+    while True:
+        try:
+            return results.get (timeout=1.0)
+        except queue.Empty:
+            if not process.is_alive ():
+                break
+
+    #
+    # The result may have been put just before the process terminated
+    #
+    try:
+        return results.get (timeout=1.0)
+    except queue.Empty:
+        return None
+
+
+#---------------------------------------------------------------------
+# MAIN
+#---------------------------------------------------------------------
+
+def main ():
+
+    #
+    # Parse command line arguments
+    #
+    parser = argparse.ArgumentParser ()
+
+    parser.add_argument ('-p', '--payments',  type=int, nargs='+', default=[1000, 10000, 100000],
+                         help='Numbers of payments of the generated backups')
+    parser.add_argument ('-e', '--engine',    type=str, default='all', choices=['dict', 'pandas', 'all'],
+                         help='Engine to be benchmarked')
+    parser.add_argument ('-d', '--directory', type=str,
+                         help='Directory keeping the generated backups between runs')
+
+    args = parser.parse_args ()
+
+    engines = ['dict', 'pandas'] if args.engine == 'all' else [args.engine]
+
+    #
+    # The last month of the generated period is exported, so the complete
+    # payment history has to be processed
+    #
+    export_month = first_year * 12 + period - 1
+
+    context = multiprocessing.get_context ('spawn')
+
+    with tempfile.TemporaryDirectory () as temporary:
+        directory = args.directory if args.directory is not None else temporary
+        os.makedirs (directory, exist_ok=True)
+
+        print ('{:>10} {:>8} {:<18} {:>10} {:>14} {:>10}'.format ('Payments', 'Engine', 'Stage', 'Seconds',
+                                                                  'Payments/s', 'Peak MB'))
+
+        for payments in args.payments:
+            filename = os.path.join (directory, 'backup-{}.zip'.format (payments))
+
+            if not os.path.exists (filename):
+                start = time.perf_counter ()
+                generateBackup (filename, payments)
+                print ('Generated {} in {:.2f} s'.format (filename, time.perf_counter () - start))
+
+            for engine in engines:
+                results = context.Queue ()
+                process = context.Process (target=runBenchmark, args=(engine, filename, export_month, results))
+                process.start ()
+                result = waitForResult (process, results)
+                process.join ()
+
+                if result is None:
+                    print ('{:>10} {:>8} failed with exit code {}'.format (payments, engine, process.exitcode))
+                    continue
+
+                stages, rows, memory = result
+
+                total = sum (seconds for stage, seconds in stages)
+
+                for stage, seconds in stages + [('total ({} rows)'.format (rows), total)]:
+                    print ('{:>10} {:>8} {:<18} {:>10.3f} {:>14.0f} {:>10.1f}'.format (
+                        payments, engine, stage, seconds, payments / max (seconds, 1e-9), memory))
+
+
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,299 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------------------------
+# datevbatch.py - Export DATEV tables of many InBehandlung backup files in parallel
+#
+# Syntax: datevbatch.py <manifest file> [-s <summary file>] [-j <number of processes>]
+#
+# The manifest is a ';' separated CSV file with the columns 'backup', 'month', 'year',
+# 'output' and the optional column 'crosscheck'. Relative file names are relative to the
+# directory of the manifest. The jobs of a backup file are processed in chronological order,
+# so each month continues with the invoice state of the previous one. If there are more
+# processes than backup files, the months of a backup are split up into several tasks.
+#
+# License: MIT License
+#-------------------------------------------------------------------------------------------------
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Frank Blankenburg
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial
+# portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#-------------------------------------------------------------------------------------------------
+
+import argparse
+import collections
+import concurrent.futures
+import csv
+import multiprocessing
+import os
+import queue
+import sys
+import time
+import warnings
+
+import datevexport
+
+#---------------------------------------------------------------------
+# Configuration
+#---------------------------------------------------------------------
+
+#
+# Columns of the summary file
+#
+summary_columns = ['Backup', 'Jahr', 'Monat', 'Ausgabe', 'Zeilen', 'Umsatz', 'Barkasse',
+                   'Warnungen', 'Sekunden', 'Fehler']
+
+
+#---------------------------------------------------------------------
+# Jobs
+#---------------------------------------------------------------------
+
+#
+# Read job list from manifest file
+#
+# @param manifest Name of the manifest file
+# @return Dictionary of (backup file, list of jobs) items. Each job is a dictionary
+#         with 'index' (position in the manifest), 'backup', 'year', 'month', 'output'
+#         and 'crosscheck' items.
+#
+def readManifest (manifest):
+    directory = os.path.dirname (os.path.abspath (manifest))
+    jobs = collections.OrderedDict ()
+    index = 0
+
+    def path (name):
+        return os.path.join (directory, name) if name else None
+
+    with open (manifest, 'r', newline='') as file:
+        for row in csv.DictReader (file, delimiter=';'):
+            job = {'index'     : index,
+                   'backup'    : path (row['backup']),
+                   'year'      : int (row['year']),
+                   'month'     : int (row['month']),
+                   'output'    : path (row['output']),
+                   'crosscheck': path (row.get ('crosscheck'))}
+
+            assert job['month'] >= 1 and job['month'] <= 12
+            assert job['year'] >= 2000
+
+            jobs.setdefault (job['backup'], []).append (job)
+            index += 1
+
+    return jobs
+
+#
+# Split the jobs into tasks processed in parallel
+#
+# The jobs of each backup are sorted chronologically. If there are more
+# processes than backups, the jobs of a backup are split up into several
+# consecutive chunks, each of which reads the backup on its own.
+#
+# @param jobs      Dictionary of (backup file, list of jobs) items as returned by 'readManifest ()'
+# @param processes Number of processes available
+# @return List of (backup file, list of jobs) tasks
+#
+def planTasks (jobs, processes):
+    tasks = []
+
+    for backup, entries in jobs.items ():
+        entries = sorted (entries, key=lambda job: (job['year'], job['month']))
+
+        chunks = max (1, min (len (entries), processes // len (jobs)))
+        size = (len (entries) + chunks - 1) // chunks
+
+        for start in range (0, len (entries), size):
+            tasks.append ((backup, entries[start:start + size]))
+
+    return tasks
+
+#
+# Process chronologically sorted jobs of a single backup file
+#
+# The backup is read once. Each month continues with the invoice state of
+# the previously exported month, so the payment history is replayed only
+# once. Errors are reported per job in the summary instead of aborting the
+# other jobs. The summary of each job is reported as soon as it is done.
+#
+# @param backup   Name of the backup ZIP file
+# @param jobs     List of jobs for this backup in chronological order
+# @param progress Queue receiving a (job index, summary) pair for each job
+#
+def runJobs (backup, jobs, progress):
+
+    try:
+        database = datevexport.loadBackup (backup)
+        totals = datevexport.Totals (database)
+    except Exception as exception:
+        for job in jobs:
+            progress.put ((job['index'], summarize (job, error=exception)))
+        return
+
+    #
+    # Invoice state at the beginning of the month 'current'
+    #
+    invoices = None
+    current = None
+
+    for job in jobs:
+        start = time.perf_counter ()
+
+        try:
+            with warnings.catch_warnings (record=True) as caught:
+                warnings.simplefilter ('always')
+
+                year, month = job['year'], job['month']
+                export_month = datevexport.monthKey (year, month)
+
+                #
+                # Continue with the invoice state of the previous job, the months
+                # in between are passed without generating any output
+                #
+                if invoices is None or current > export_month:
+                    invoices = datevexport.createInvoices (database, year, month)
+                else:
+                    for skipped in range (current, export_month):
+                        datevexport.MonthExport (database, *datevexport.keyToMonth (skipped), invoices).run ()
+
+                current = None
+
+                #
+                # The DATEV rows are written while the payments of the month are
+                # processed, the crosscheck rows and totals are complete afterwards
+                #
+                export = datevexport.MonthExport (database, year, month, invoices)
+
+                rows = datevexport.writeRows (job['output'], datevexport.datev_columns,
+                                              (entry.toDatev () for entry in export.entries ()))
+
+                current = export_month + 1
+
+                if job['crosscheck']:
+                    datevexport.writeRows (job['crosscheck'],
+                                           ['Datum', 'Betrag', 'Zahlweise', 'Rechnungsnummer', 'Name'],
+                                           export.crosscheck ())
+
+            summary = summarize (job, rows=rows, turnover=export.turnover,
+                                 petty_cash=totals.pettyCash (export_month + 1),
+                                 warnings=len (caught), seconds=time.perf_counter () - start)
+
+        except Exception as exception:
+            summary = summarize (job, error=exception, seconds=time.perf_counter () - start)
+
+            #
+            # The invoice state is undefined if the month has not been processed completely
+            #
+            if current is None:
+                invoices = None
+
+        progress.put ((job['index'], summary))
+
+#
+# Create summary of a single job
+#
+def summarize (job, rows=0, turnover=0, petty_cash=0, warnings=0, seconds=0.0, error=None):
+    return {'Backup'   : job['backup'],
+            'Jahr'     : job['year'],
+            'Monat'    : job['month'],
+            'Ausgabe'  : job['output'],
+            'Zeilen'   : rows,
+            'Umsatz'   : datevexport.formatAmount (turnover),
+            'Barkasse' : datevexport.formatAmount (petty_cash),
+            'Warnungen': warnings,
+            'Sekunden' : '{:.2f}'.format (seconds),
+            'Fehler'   : '' if error is None else '{}: {}'.format (type (error).__name__, error)}
+
+
+#---------------------------------------------------------------------
+# MAIN
+#---------------------------------------------------------------------
+
+def main ():
+
+    #
+    # Parse command line arguments
+    #
+    parser = argparse.ArgumentParser ()
+
+    parser.add_argument ('manifest',        type=str, help='Name of the manifest file')
+    parser.add_argument ('-s', '--summary', type=str, help='Name of the summary file')
+    parser.add_argument ('-j', '--jobs',    type=int, default=os.cpu_count (),
+                         help='Number of backups processed in parallel')
+
+    args = parser.parse_args ()
+
+    jobs = readManifest (args.manifest)
+    count = sum (len (entries) for entries in jobs.values ())
+    tasks = planTasks (jobs, max (1, args.jobs))
+
+    #
+    # Job summaries in manifest order (job index, summary)
+    #
+    summaries = {}
+    failed = 0
+
+    def report (index, summary):
+        nonlocal failed
+
+        summaries[index] = summary
+
+        if summary['Fehler']:
+            failed += 1
+            print ('[{}/{}] {} {:02d}/{}: FEHLER {}'.format (
+                len (summaries), count, summary['Backup'], summary['Monat'], summary['Jahr'], summary['Fehler']))
+        else:
+            print ('[{}/{}] {} {:02d}/{}: {} Zeilen, Umsatz {} Euro, Barkasse {} Euro'.format (
+                len (summaries), count, summary['Backup'], summary['Monat'], summary['Jahr'],
+                summary['Zeilen'], summary['Umsatz'], summary['Barkasse']))
+
+        sys.stdout.flush ()
+
+    with multiprocessing.Manager () as manager:
+        progress = manager.Queue ()
+
+        with concurrent.futures.ProcessPoolExecutor (max_workers=max (1, min (args.jobs, len (tasks)))) as pool:
+            futures = {pool.submit (runJobs, backup, entries, progress): entries for backup, entries in tasks}
+
+            #
+            # Report each job as soon as it is done. The jobs of a task whose process
+            # died are reported as failed once all of its regular reports have arrived.
+            #
+            while len (summaries) < count:
+                try:
+                    report (*progress.get (timeout=0.5))
+                    continue
+                except queue.Empty:
+                    pass
+
+                for future, entries in futures.items ():
+                    if future.done () and future.exception () is not None:
+                        for job in entries:
+                            if job['index'] not in summaries:
+                                report (job['index'], summarize (job, error=future.exception ()))
+
+    #
+    # Write summary in manifest order
+    #
+    if args.summary is not None:
+        datevexport.writeRows (args.summary, summary_columns,
+                               ([summaries[index][column] for column in summary_columns]
+                                for index in sorted (summaries)))
+
+    if failed > 0:
+        sys.exit (1)
+
+
+if __name__ == '__main__':
+    main ()
@@ -4,6 +4,8 @@
 # datevexport.py - Export monthly DATEV table from InBehandlung backup file database
 #
 # Syntax: datevexport.py <backup zip file> <month (MM)> <year (YYYY)> <output file>
+#         datevexport.py <backup zip file> -f <YYYY-MM> -t <YYYY-MM> -k <cash book file> [--daily]
+#         datevexport.py <backup zip file> -m <MM> -y <YYYY> -o <output file> --since-backup <previous backup zip file>
 #
 # License: MIT License
 #-------------------------------------------------------------------------------------------------
@@ -28,14 +30,30 @@
 #-------------------------------------------------------------------------------------------------
 
 import argparse
+import array
+import collections
+import concurrent.futures
 import copy
 import csv
 import datetime
+import hashlib
 import io
-import locale
+import json
+import math
+import os
+import re
+import sys
 import warnings
 import zipfile
 
+#
+# NumPy is optional. If present, the invoice line items are summed up vectorised.
+#
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 #---------------------------------------------------------------------
 # Configuration
 #---------------------------------------------------------------------
@@ -66,6 +84,21 @@ class Accounts:
     Products_19            = 8034
     Products_7             = 8031
 
+#
+# Item domains the invoice totals are split into
+#
+class Domains:
+
+    Products          = 0
+    Medication        = 1
+    MedicationApplied = 2
+    Services          = 3
+
+    #
+    # DATEV item kind ('Sachverhalt') of each domain
+    #
+    kinds = ['Produkte', 'Medikamente (abgegeben)', 'Medikamente (angewendet)', 'Leistungen']
+
 
 #
 # DATEV table column headers
@@ -228,6 +261,70 @@ datev_column_mapping = {
     'leistungsdatum'    : 115
 }
 
+#
+# CSV dialect of the DATEV and crosscheck files
+#
+csv.register_dialect ('datev',
+                      delimiter=';',
+                      quoting=csv.QUOTE_ALL,
+                      quotechar='"')
+
+#
+# Tables read from the backup ZIP file as (table name, (column name, column type))
+# items. Only the listed columns are kept, all other columns and tables of the
+# backup are skipped while reading. Money columns ('cents') are kept as integer
+# cents, line item prices as floats because they may be fractions of a cent.
+#
+line_item_columns = {
+    'id'        : 'str',
+    'invoice_id': 'str',
+    'tax_id'    : 'str',
+    'price'     : 'float',
+    'amount'    : 'float',
+    'factor'    : 'float',
+    'count'     : 'float'
+}
+
+database_tables = {
+    'invoices'          : {'id'         : 'str',
+                           'number'     : 'str',
+                           'status'     : 'str',
+                           'date'       : 'str',
+                           'client_id'  : 'str',
+                           'total'      : 'cents'},
+    'invoice_medication': dict (line_item_columns, applied='str'),
+    'invoice_product'   : line_item_columns,
+    'invoice_service'   : line_item_columns,
+    'payments'          : {'id'         : 'str',
+                           'invoice_id' : 'str',
+                           'method'     : 'str',
+                           'paymenttype': 'str',
+                           'notes'      : 'str',
+                           'username'   : 'str',
+                           'deleted'    : 'str',
+                           'amount'     : 'cents',
+                           'date'       : 'date'},
+    'tax'               : {'id'         : 'str',
+                           'tax'        : 'str'},
+    'clients'           : {'id'         : 'str',
+                           'lastname'   : 'str'}
+}
+
+#
+# Column indices created for the file databases at load time as (keys, order)
+# pairs. Each index is addressed by the tuple of column names it covers, the
+# ids of each index entry are sorted by the optional order column. The index
+# over no columns at all keeps every payment in date order.
+#
+database_indices = {
+    'invoice_product'   : [(('invoice_id',), None)],
+    'invoice_medication': [(('invoice_id', 'applied'), None)],
+    'invoice_service'   : [(('invoice_id',), None)],
+    'payments'          : [(('invoice_id',), 'date'),
+                           (('date_month',), None),
+                           ((), 'date')]
+}
+
 
 #---------------------------------------------------------------------
 # Auxillary functions
@@ -237,70 +334,164 @@ datev_column_mapping = {
 # Round into full euro and cents
 #
 def roundEuro (n):
-    return round (100.0 * n + 0.0001) / 100.0
+    return toCents (n) / 100.0
+
+#
+# Convert amount in euro into integer cents
+#
+def toCents (n):
+    return round (100.0 * n + 0.0001)
+
+#
+# Format amount in integer cents with two decimals and German decimal comma
+# ('1234,56'). The process locale is not used, so formatting is safe in threads
+# and on hosts without German locale.
+#
+def formatAmount (cents):
+    return '%s%d,%02d' % ('-' if cents < 0 else '', abs (cents) // 100, abs (cents) % 100)
+
+#
+# Format date as day, month and year ('DDMMYYYY' or e.g. 'DD-MM-YYYY' with separator)
+# independent of the process locale
+#
+def formatDate (date, separator=''):
+    return '%02d%s%02d%s%04d' % (date.day, separator, date.month, separator, date.year)
 
 #
-# Convert CSV date string representation into Python date class
+# Convert CSV date string representation into Python date class. The fixed
+# 'YYYY-MM-DD HH:MM:SS' format is sliced directly, which is much faster than
+# parsing it via 'strptime'.
 #
 def stringToDate (text):
-    return datetime.datetime.strptime (text, '%Y-%m-%d %H:%M:%S')
+    if len (text) != 19 or text[4] != '-' or text[7] != '-' or text[10] != ' ':
+        raise ValueError ("Invalid date '{}'".format (text))
+
+    return datetime.datetime (int (text[0:4]), int (text[5:7]), int (text[8:10]),
+                              int (text[11:13]), int (text[14:16]), int (text[17:19]))
+
+#
+# Convert Python date class into CSV date string representation
+#
+def dateToString (date):
+    return date.strftime ('%Y-%m-%d %H:%M:%S')
+
+#
+# Sort key of a date. Missing dates ('None') are placed before all other dates,
+# like their month key of -1 is placed before all other months.
+#
+def dateOrder (date):
+    return (date is not None, date)
+
+#
+# Convert year and month into a single ascending month number
+#
+def monthKey (year, month):
+    return year * 12 + month - 1
+
+#
+# Convert month key back into (year, month) tuple
+#
+def keyToMonth (key):
+    return (key // 12, key % 12 + 1)
+
+#
+# Convert 'YYYY-MM' month string representation into month key
+#
+def stringToMonth (text):
+    year, month = (int (part) for part in text.split ('-'))
+    assert month >= 1 and month <= 12
+    assert year >= 2000
+    return monthKey (year, month)
 
 
 #---------------------------------------------------------------------
 # CLASS FileDatabase
 #
-# This class keeps the content of a single CSV file in a data frame
-# like format
+# This class keeps the content of a single CSV file in a column
+# oriented format with one typed column per CSV column
 #---------------------------------------------------------------------
 
 class FileDatabase:
 
+    #
+    # Column storage types as (column factory, cell conversion) pairs. 'NULL'
+    # cells are stored as empty string, NaN, 0 cents or None depending on the type.
+    # Each date column is complemented by a '<column>_month' column containing
+    # the month key of the date or -1 for 'NULL' cells.
+    #
+    types = {
+        'str'  : (list,
+                  lambda text: sys.intern (text) if text != 'NULL' else ''),
+        'float': (lambda: array.array ('d'),
+                  lambda text: float (text) if text != 'NULL' else math.nan),
+        'cents': (lambda: array.array ('q'),
+                  lambda text: toCents (float (text)) if text != 'NULL' else 0),
+        'date' : (list,
+                  lambda text: stringToDate (text) if text != 'NULL' else None)
+    }
+
     #
     # Constructor
     #
-    # @param file Opened file containing the CSV data. File content will be read here.
+    # @param file    Opened file containing the CSV data. File content will be read here.
+    # @param columns Dictionary of (column name, column type) items of the columns
+    #                to be kept. All other columns of the file are skipped.
     #
-    def __init__ (self, file):
+    def __init__ (self, file, columns):
 
         #
-        # Database content (id, row content)
+        # Database content (column name, typed column)
         #
-        self._data = {}
+        self._columns = {}
+
+        #
+        # Row positions (id, position in the columns)
+        #
+        self._rows = {}
+
+        #
+        # Column indices (column name tuple, (value tuple, ids))
+        #
+        self._indices = {}
 
         reader = csv.reader (io.TextIOWrapper (file, 'utf-8'), delimiter=',', quotechar='\"')
 
-        keys = {}
-        header_read = False
+        #
+        # The first row contains the header with the column names. Only the
+        # requested columns get a (cell index, append, convert) converter.
+        #
+        header = next (reader, [])
+        converters = []
+
+        for i in range (len (header)):
+            key = header[i]
 
-        for row in reader:
-            #
-            # The first row contains the header with the column names
-            #
-            if not header_read:
-                for i in range (len (row)):
-                    keys[i] = row[i]
+            if key in columns:
+                factory, convert = self.types[columns[key]]
+                self._columns[key] = factory ()
+                converters.append ((i, self._columns[key].append, convert))
 
-                header_read = True
+        assert 'id' in self._columns
+        ids = self._columns['id']
 
-            #
-            # All other rows create a dictionary with (column name, cell content) items
-            #
-            else:
-                id = None
-                line = {}
+        #
+        # All other rows are appended cell by cell to the matching columns
+        #
+        for row in reader:
+            if len (row) < len (header):
+                row += ['NULL'] * (len (header) - len (row))
 
-                for i in range (len (row)):
-                    key = keys[i]
+            for i, append, convert in converters:
+                append (convert (row[i]))
 
-                    if (key == 'id'):
-                        id = row[i]
-                    if (row[i] != 'NULL'):
-                        line[key] = row[i]
-                    else:
-                        line[key] = ''
+            self._rows[ids[-1]] = len (ids) - 1
+
+        for key in [key for key in self._columns if columns[key] == 'date']:
+            self._columns[key + '_month'] = \
+                array.array ('l', [monthKey (date.year, date.month) if date is not None else -1
+                                   for date in self._columns[key]])
 
-                assert id is not None
-                self._data[id] = line
+        self._ids = sorted (self._rows.keys ())
 
     #
     # Check if the database supports the given key
@@ -308,8 +499,15 @@ class FileDatabase:
     # @param key Key to check
     #
     def has (self, key):
-        id = list (self._data.keys ())[0]
-        return key in self._data[id]
+        return key in self._columns
+
+    #
+    # Check if an entry with the given id is present
+    #
+    # @param id Id of the entry
+    #
+    def contains (self, id):
+        return id in self._rows
 
     #
     # Return single cell content
@@ -318,20 +516,81 @@ class FileDatabase:
     # @param key Key of the column to access
     #
     def get (self, id, key):
-        assert id in self._data
+        assert id in self._rows
+        assert key in self._columns
 
-        data = self._data[id]
-
-        assert isinstance (data, dict)
-        assert key in data
-
-        return data[key]
+        return self._columns[key][self._rows[id]]
 
     #
     # Return range of ids present in the file database
     #
     def range (self):
-        return sorted (self._data.keys ())
+        return self._ids
+
+    #
+    # Return complete typed column in file order
+    #
+    # @param key Key of the column to access
+    #
+    def column (self, key):
+        assert key in self._columns
+        return self._columns[key]
+
+    #
+    # Return content digests of all rows
+    #
+    # @return Dictionary of (id, digest over all kept columns of the row) items
+    #
+    def digests (self):
+        columns = [self._columns[key] for key in sorted (self._columns)]
+
+        return {id: hashlib.sha256 (repr ([column[row] for column in columns]).encode ('utf-8')).hexdigest ()
+                for id, row in self._rows.items ()}
+
+    #
+    # Create index over the given columns
+    #
+    # @param keys  Tuple of column names to be indexed
+    # @param order Date column the ids of each index entry are sorted by, ids without
+    #              date first. If 'None', the ids are kept in ascending id order.
+    #
+    def createIndex (self, keys, order=None):
+        index = {}
+
+        columns = [self._columns[key] for key in keys]
+
+        for id in self.range ():
+            row = self._rows[id]
+            index.setdefault (tuple (column[row] for column in columns), []).append (id)
+
+        if order is not None:
+            column = self._columns[order]
+
+            for ids in index.values ():
+                ids.sort (key=lambda id: dateOrder (column[self._rows[id]]))
+
+        self._indices[keys] = index
+
+    #
+    # Return ids of all entries matching the given column values
+    #
+    # @param keys   Tuple of column names of an existing index
+    # @param values Tuple of column values to look up
+    # @return List of matching ids in index order
+    #
+    def lookup (self, keys, values):
+        assert keys in self._indices
+        return self._indices[keys].get (values, [])
+
+    #
+    # Return all values present in an index
+    #
+    # @param keys Tuple of column names of an existing index
+    # @return Sorted list of value tuples
+    #
+    def values (self, keys):
+        assert keys in self._indices
+        return sorted (self._indices[keys].keys ())
 
 
 #---------------------------------------------------------------------
@@ -365,6 +624,16 @@ class Database:
         assert database in self._data
         return self._data[database].has (key)
 
+    #
+    # Check if an entry with the given id is present in a file database
+    #
+    # @param database Name of the file database to access
+    # @param id       Id of the entry
+    #
+    def contains (self, database, id):
+        assert database in self._data
+        return self._data[database].contains (id)
+
     #
     # Return range of ids present in the file database
     #
@@ -372,29 +641,150 @@ class Database:
         assert database in self._data
         return self._data[database].range ()
 
+    #
+    # Return complete typed column of a file database in file order
+    #
+    # @param database Name of the file database to access
+    # @param key      Key of the column to access
+    #
+    def column (self, database, key):
+        assert database in self._data
+        return self._data[database].column (key)
+
+    #
+    # Return content digests of all rows of a file database
+    #
+    # @param database Name of the file database to access
+    #
+    def digests (self, database):
+        assert database in self._data
+        return self._data[database].digests ()
+
+    #
+    # Return ids of all entries of a file database matching the given column values
+    #
+    # @param database Name of the file database to access
+    # @param keys     Tuple of column names of an existing index
+    # @param values   Tuple of column values to look up
+    #
+    def lookup (self, database, keys, values):
+        assert database in self._data
+        return self._data[database].lookup (keys, values)
+
+    #
+    # Return all values present in an index of a file database
+    #
+    # @param database Name of the file database to access
+    # @param keys     Tuple of column names of an existing index
+    #
+    def values (self, database, keys):
+        assert database in self._data
+        return self._data[database].values (keys)
+
     #
     # Read new file database and add it to the content
     #
     def add (self, file, name):
-        self._data[name] = FileDatabase (file)
+        self._data[name] = Database.read (file, name)
+
+    #
+    # Read all registered file databases from a backup ZIP file. All other
+    # archive members are skipped without being decompressed.
+    #
+    # @param filename Name of the backup ZIP file
+    # @param jobs     Number of worker processes reading tables concurrently
+    # @param context  'multiprocessing' context starting the worker processes. If 'None',
+    #                 the default start method of the platform is used.
+    #
+    def load (self, filename, jobs=1, context=None):
+        entries = {}
+
+        with zipfile.ZipFile (filename) as archive:
+            for entry in archive.namelist ():
+                for name in database_tables:
+                    if entry.endswith (name + '.csv'):
+                        entries[name] = entry
+                        break
+
+        names = list (entries.keys ())
+        arguments = ([filename] * len (names), [entries[name] for name in names], names)
+
+        if jobs > 1 and len (names) > 1:
+            with concurrent.futures.ProcessPoolExecutor (max_workers=min (jobs, len (names)), mp_context=context) as pool:
+                tables = list (pool.map (readTable, *arguments))
+        else:
+            tables = list (map (readTable, *arguments))
+
+        for name, table in zip (names, tables):
+            self._data[name] = table
+
+    #
+    # Read file database with the registered columns and indices
+    #
+    # @param file Opened file containing the CSV data
+    # @param name Name of the file database
+    #
+    @staticmethod
+    def read (file, name):
+        table = FileDatabase (file, database_tables[name])
+
+        for keys, order in database_indices.get (name, []):
+            table.createIndex (keys, order)
+
+        return table
+
+
+#
+# Read a single file database from a backup ZIP file. Each call opens its own
+# ZIP file handle, so that the tables can be read in separate worker processes.
+#
+# @param filename Name of the backup ZIP file
+# @param entry    Name of the CSV file in the archive
+# @param name     Name of the file database
+# @return Read file database
+#
+def readTable (filename, entry, name):
+    with zipfile.ZipFile (filename) as archive:
+        with archive.open (entry, 'r') as file:
+            return Database.read (file, name)
 
 
 #---------------------------------------------------------------------
 # CLASS Invoice
 #---------------------------------------------------------------------
 
+#
+# Part of an invoice debt with a common domain and tax rate. 'domain' is one of
+# the 'Domains' constants, 'account' the matching source account number and
+# 'sum' the amount in integer cents.
+#
+DebtPart = collections.namedtuple ('DebtPart', ['domain', 'tax', 'account', 'sum'])
+
 #
 # This class keeps record about a single invoice, split into different
 # tax related parts
 #
 class Invoice:
 
+    #
+    # Line item files the invoice parts are summed up from as (domain, file, conditions)
+    # entries, in the order the parts are collected
+    #
+    contents = [(Domains.Products,          'invoice_product',    {}),
+                (Domains.Medication,        'invoice_medication', {'applied': '0'}),
+                (Domains.MedicationApplied, 'invoice_medication', {'applied': '1'}),
+                (Domains.Services,          'invoice_service',    {})]
+
     #
     # Constructor
     #
-    # @param id Unique invoice id
+    # @param id    Unique invoice id
+    # @param debt  Invoice parts as computed by 'sumContents ()'. If 'None', the
+    #              parts are summed up from the line items of this invoice.
+    # @param state Allocation state as returned by 'getState ()'. If given, the invoice
+    #              continues from this state and its line items are not summed up at all.
     #
-    def __init__ (self, database, id):
+    def __init__ (self, database, id, debt=None, state=None):
 
         #
         # Gather some information about the invoice itself
@@ -402,9 +792,18 @@ class Invoice:
         self._id = id
         self._number = database.get ('invoices', id, 'number')
 
-        self._total = float (database.get ('invoices', id, 'total'))
+        self._total = database.get ('invoices', id, 'total')
         self._open = self._total
 
+        #
+        # Applied payments as (payment id, paid parts) events, if recorded for the allocation log
+        #
+        self._events = None
+
+        if state is not None:
+            self.setState (state)
+            return
+
         #
         # Collect parts of the invoice which must sum up to the total and
         # will be used to split the total into the different tax parts
@@ -412,41 +811,44 @@ class Invoice:
         if False:
             print ('Invoice: ' + str (id) + ' (' + self._number + ')')
 
-        self._debt = []
-        self._debt += self.sumContent (database, 'products',           'invoice_product',    id, {})
-        self._debt += self.sumContent (database, 'medication',         'invoice_medication', id, {'applied': '0'})
-        self._debt += self.sumContent (database, 'medication_applied', 'invoice_medication', id, {'applied': '1'})
-        self._debt += self.sumContent (database, 'services',           'invoice_service',    id, {})
+        if debt is None:
+            debt = []
+
+            for domain, file, conditions in self.contents:
+                debt += self.sumContent (database, domain, file, id, conditions)
+        else:
+            debt = list (debt)
 
         #
         # IMPORTANT OPTIMIZATION: Lower tax items are processed FIRST because if
         # a customer does only pay a part of an invoice, we will have to pay
-        # less taxes at least.
+        # less taxes at least. The parts are consumed from the front of a deque.
         #
-        self._debt.sort (key=lambda entry: float (database.get ('tax', entry['tax'], 'tax')))
+        debt.sort (key=lambda entry: float (database.get ('tax', entry.tax, 'tax')))
+        self._debt = collections.deque (debt)
 
-        total = 0.0
+        total = 0
         for item in self._debt:
-            total += item['sum']
+            total += item.sum
 
         if False:
             print ('  --> total (invoice): ' + str (self._total) + ', sum (parts): ' + str (total))
 
-        if roundEuro (self._total) != roundEuro (total):
+        if self._total != total:
             print ('ERROR: Parts of invoice ' + str (id) + " to not sum up. Total is " +
-                   str (roundEuro (self._total)) + ", sum is " +
-                   str (total) + ".")
+                   str (self._total / 100.0) + ", sum is " +
+                   str (total / 100.0) + ".")
 
     #
     # Sum content of a database file belonging to a given invoice id
     #
     # @param database    Database we are working with
-    # @param domain      Item domain (product, service, medication, ...)
+    # @param domain      Item domain ('Domains' constant)
     # @param file        Database file containing the detailed items
     # @param invoice_id  Id of the invoice processed
     # @param conditions  Additional conditions for the invoice data set to be
     #                    valid for this case
-    # @return List of invoice parts consisting of (domain, tax, account, sum) dictionaries
+    # @return List of invoice debt parts
     #
     @staticmethod
     def sumContent (database, domain, file, invoice_id, conditions):
@@ -457,50 +859,45 @@ class Invoice:
         total = {}
 
         #
-        # Iterate over invoice detail entries and process matching items
+        # Iterate over the invoice detail entries matching the invoice id and the
+        # additional conditions via the file index
         #
-        for id in database.range (file):
-            if database.get (file, id, 'invoice_id') == invoice_id:
-
-                #
-                # If additional conditions have been specified, these have
-                # to match the dataset, too
-                #
-                matches = True
+        keys = ('invoice_id',) + tuple (sorted (conditions.keys ()))
+        values = (invoice_id,) + tuple (conditions[key] for key in keys[1:])
 
-                for key in conditions:
-                    if database.get (file, id, key) != conditions[key]:
-                        matches = False
+        has_amount = database.has (file, 'amount')
+        has_factor = database.has (file, 'factor')
+        has_count  = database.has (file, 'count')
 
-                if matches:
-                    amount = 1.0
-                    if database.has (file, 'amount'):
-                        amount = float (database.get (file, id, 'amount'))
+        for id in database.lookup (file, keys, values):
+            amount = 1.0
+            if has_amount:
+                amount = database.get (file, id, 'amount')
 
-                    factor = 1.0
-                    if database.has (file, 'factor'):
-                        factor = float (database.get (file, id, 'factor'))
+            factor = 1.0
+            if has_factor:
+                factor = database.get (file, id, 'factor')
 
-                    count = 1.0
-                    if database.has (file, 'count'):
-                        count = float (database.get (file, id, 'count'))
+            count = 1.0
+            if has_count:
+                count = database.get (file, id, 'count')
 
-                    tax_id = database.get (file, id, 'tax_id')
+            tax_id = database.get (file, id, 'tax_id')
 
-                    price = float (database.get (file, id, 'price'))
+            price = database.get (file, id, 'price')
 
-                    if tax_id not in total:
-                        total[tax_id] = 0.0
+            if tax_id not in total:
+                total[tax_id] = 0
 
-                    total[tax_id] += roundEuro (amount * factor * count * price)
+            total[tax_id] += toCents (amount * factor * count * price)
 
-                    if False:
-                        print ('  ' + file + ', ' + str (amount) +
-                               ' * ' + str (factor) +
-                               ' * ' + str (count) +
-                               ' * ' + str (price) +
-                               ' = ' + str (roundEuro (amount * factor * count * price)) +
-                               ' (' + str (amount * factor * count * price) + ')')
+            if False:
+                print ('  ' + file + ', ' + str (amount) +
+                       ' * ' + str (factor) +
+                       ' * ' + str (count) +
+                       ' * ' + str (price) +
+                       ' = ' + str (roundEuro (amount * factor * count * price)) +
+                       ' (' + str (amount * factor * count * price) + ')')
 
         #
         # Generate result entries containing a domain/tax depending set of entries
@@ -508,66 +905,188 @@ class Invoice:
         result = []
 
         for tax_id in total.keys ():
-            result.append ({'domain' : domain,
-                            'tax'    : tax_id,
-                            'account': Invoice.computeTaxAccount (database, domain, tax_id),
-                            'sum'    : total[tax_id]})
+            result.append (DebtPart (domain, tax_id, Invoice.computeTaxAccount (database, domain, tax_id),
+                                     total[tax_id]))
 
         return result
 
+    #
+    # Sum content of the line item files for all invoices at once
+    #
+    # The line items are rounded to cents in a single vectorised step and summed
+    # up grouped by (invoice id, domain, tax id). The parts of each invoice are
+    # in the same order as collected by 'sumContent ()'. Line items of all other
+    # invoices are skipped before their tax accounts are resolved. Requires NumPy.
+    #
+    # @param database    Database we are working with
+    # @param invoice_ids Ids of the invoices to be summed up
+    # @return Dictionary of (invoice id, list of invoice debt parts) items
+    #
+    @staticmethod
+    def sumContents (database, invoice_ids):
+
+        if not invoice_ids:
+            return {}
+
+        invoice_ids = np.array (list (invoice_ids))
+        groups = []
+
+        for index, (domain, file, conditions) in enumerate (Invoice.contents):
+            ids = np.array (database.column (file, 'id'))
+
+            if len (ids) == 0:
+                continue
+
+            #
+            # Line items in id order, like delivered by the invoice index
+            #
+            order = np.argsort (ids, kind='stable')
+            order = order[np.isin (np.array (database.column (file, 'invoice_id'))[order], invoice_ids)]
+
+            for key, value in conditions.items ():
+                order = order[np.array (database.column (file, key))[order] == value]
+
+            product = np.ones (len (ids))
+            for key in ['amount', 'factor', 'count']:
+                if database.has (file, key):
+                    product = product * np.asarray (database.column (file, key))
+
+            cents = np.round (100.0 * (product * np.asarray (database.column (file, 'price'))) + 0.0001)[order]
+
+            #
+            # Group by (invoice id, tax id). The position of the first line item of
+            # each group keeps the order the tax ids appear in.
+            #
+            if len (order) == 0:
+                continue
+
+            invoices, invoice_codes = np.unique (np.array (database.column (file, 'invoice_id'))[order],
+                                                 return_inverse=True)
+            tax_ids, tax_codes = np.unique (np.array (database.column (file, 'tax_id'))[order],
+                                            return_inverse=True)
+
+            keys, first, inverse = np.unique (invoice_codes.astype (np.int64) * len (tax_ids) + tax_codes,
+                                              return_index=True, return_inverse=True)
+
+            groups.append ((invoices[keys // len (tax_ids)],
+                            np.full (len (keys), index),
+                            first,
+                            tax_ids[keys % len (tax_ids)],
+                            np.bincount (inverse, weights=cents, minlength=len (keys))))
+
+        if not groups:
+            return {}
+
+        invoices, indices, first, tax_ids, sums = (np.concatenate (column) for column in zip (*groups))
+
+        #
+        # Generate the parts of each invoice in content and tax id order
+        #
+        debts = {}
+        accounts = {}
+
+        order = np.lexsort ((first, indices, invoices))
+
+        for invoice_id, index, tax_id, sum in zip (invoices[order].tolist (), indices[order].tolist (),
+                                                   tax_ids[order].tolist (), sums[order].tolist ()):
+            domain = Invoice.contents[index][0]
+
+            if (domain, tax_id) not in accounts:
+                accounts[(domain, tax_id)] = Invoice.computeTaxAccount (database, domain, tax_id)
+
+            debts.setdefault (invoice_id, []).append (DebtPart (domain, tax_id, accounts[(domain, tax_id)], int (sum)))
+
+        return debts
+
     #
     # Apply payment to invoice and reduce the appropriate debt items
     #
     # @param database   Database we are working with
     # @param payment_id Id of the payment to process
-    # @return List of the partial payments as (domain, tax, sum) dictionary
+    # @return List of the partial payments as debt parts
     #
     def applyPayment (self, database, payment_id):
 
+        parts = self.consume (database.get ('payments', payment_id, 'amount'))
+
+        if self._events is not None:
+            self._events.append ((payment_id, parts))
+
+        if self._open < 0:
+            warnings.warn ('Überzahlung in Rechnung {rechnung}, Zahlungsnummer {zahlung}. Theoretisches Guthaben von {betrag}.'
+                           .format (rechnung=self._number, zahlung=payment_id, betrag=abs (self._open) / 100.0), RuntimeWarning)
+
+        return parts
+
+    #
+    # Reduce the invoice debt by a paid amount
+    #
+    # Because the debt items are always consumed from the front, the remaining
+    # debt depends on the sum of all paid amounts only, not on their order.
+    #
+    # @param sum Paid amount in cents
+    # @return List of the paid debt parts
+    #
+    def consume (self, sum):
+
         parts = []
 
         #
         # Subtract payment amount from invoice sum. Because the sum is split
         # up in (a) domains (services, products, medication, ) and (b) in
-        # tax rates, the different items have to be reduced one by one.
+        # tax rates, the different items have to be reduced one by one. All
+        # amounts are integer cents, so no rounding is necessary.
         #
-        sum = roundEuro (float (database.get ('payments', payment_id, 'amount')))
-        self._open = roundEuro (self._open - sum)
+        self._open -= sum
 
-        while sum > 0.0 and len (self._debt) > 0:
+        while sum > 0 and self._debt:
             entry = self._debt[0]
 
             #
             # Case 1: Partial payment of an entry
             #
-            if sum < entry['sum']:
-                entry['sum'] = roundEuro (entry['sum'] - sum)
+            if sum < entry.sum:
+                self._debt[0] = entry._replace (sum=entry.sum - sum)
+                parts.append (entry._replace (sum=sum))
 
-                part = copy.deepcopy (entry)
-                part['sum'] = sum
-                parts.append (part)
-
-                sum = 0.0
+                sum = 0
 
             #
             # Case 2: Entry fully paid
             #
             else:
-                sum = roundEuro (sum - entry['sum'])
-                parts.append (copy.deepcopy (entry))
-                self._debt.pop (0)
-
-        if self._open < 0.0:
-            warnings.warn ('Überzahlung in Rechnung {rechnung}, Zahlungsnummer {zahlung}. Theoretisches Guthaben von {betrag}.'
-                           .format (rechnung=self._number, zahlung=payment_id, betrag=abs (self._open)), RuntimeWarning)
+                sum -= entry.sum
+                parts.append (self._debt.popleft ())
 
         return parts
 
+    #
+    # Return digest identifying the invoice content. Must be called before any
+    # payment has been applied.
+    #
+    def digest (self):
+        return hashlib.sha256 (repr ((self._number, self._total, self._debt)).encode ('utf-8')).hexdigest ()
+
+    #
+    # Return allocation state of the invoice as JSON compatible dictionary
+    #
+    def getState (self):
+        return {'open': self._open, 'debt': list (self._debt)}
+
+    #
+    # Restore allocation state of the invoice
+    #
+    # @param state Allocation state as returned by 'getState ()'
+    #
+    def setState (self, state):
+        self._open = state['open']
+        self._debt = collections.deque (DebtPart (*part) for part in state['debt'])
+
     #
     # Return tax account number matching the invoice part configuration
     #
     # @param database Database we are working with
-    # @param domain   Domain (products, services, medications, ...)
+    # @param domain   Domain ('Domains' constant)
     # @param tax_id   Internal ID of the tax used
     # @return Account number matching the configuration
     #
@@ -582,514 +1101,1823 @@ class Invoice:
         #
         assert tax == 19.0 or tax == 7.0 or tax == 0.0
 
-        if domain == 'products':
+        if domain == Domains.Products:
             account = Accounts.Products_19 if tax == 19.0 else Accounts.Products_7
-        elif domain == 'medication':
+        elif domain == Domains.Medication:
             account = Accounts.Medications_19 if tax == 19.0 else Accounts.Medications_7
-        elif domain == 'medication_applied':
+        elif domain == Domains.MedicationApplied:
             account = Accounts.Medications_Applied_19 if tax == 19.0 else Accounts.Medications_Applied_7
-        elif domain == 'services':
+        elif domain == Domains.Services:
             account = Accounts.Services_19 if tax == 19.0 else Accounts.Services_7
         else:
-            raise "Unknown database domain '{}'".format (domain)
+            raise ValueError ("Unknown database domain '{}'".format (domain))
 
         return account
 
 
 
 #---------------------------------------------------------------------
-# CLASS DatevEntry
+# CLASS Snapshot
+#
+# This class keeps the allocation state of all invoices at the beginning
+# of a month on disk, so later runs can resume from there instead of
+# replaying the complete payment history. The snapshot directory belongs
+# to a single practice, so the snapshots are reused by later backups of
+# the same practice. A snapshot is taken over as is if the backup content
+# is unchanged. Otherwise it is only valid as long as the payment history
+# before its month is unchanged and is checked invoice by invoice. If there
+# is no valid snapshot for the requested month, the latest valid earlier
+# one is used and the payments since are applied on top.
 #---------------------------------------------------------------------
 
-#
-# Class representing a single DATEV file entry
-#
-# Valid fields are:
-#
-# - invoice_id       - Id of the invoice
-# - invoice_date     - Date of the invoice
-# - payment_id       - Id of the payment itself
-# - payment_date     - Date of payment
-# - payment_kind     - Way of payment (cash, card, ...)
-# - payment_type     - Type of payment (transfer, ...)
-# - item_kind        - Kind of item applied/sold
-# - item_date        - Date the item was applied/sold
-# - item_description - Description of the item
-# - item_tax         - Tax of the item
-# - customer_id      - Id of the customer
-# - amount           - Amount of money
-# - remarks          - Payment remarks
-# - responsible      - Name of the responsible person
-# - account_from     - Account where the money came from
-# - account_to       - Account where the money goes to
-class DatevEntry:
+class Snapshot:
 
     #
-    # Constructor (all kinds of payments)
+    # Payment columns covered by the history digest
     #
-    # @param database   Database we are working with
-    # @param payment_id Id of the payment to be processed
+    payment_keys = ['id', 'invoice_id', 'amount', 'date', 'deleted', 'method']
+
+    #
+    # Tables covered by the backup fingerprint
+    #
+    tables = ['invoices', 'invoice_medication', 'invoice_product', 'invoice_service', 'payments', 'tax']
+
+    #
+    # Constructor
+    #
+    # @param directory Directory the snapshot files of the practice are kept in
+    # @param backup    Name of the processed backup ZIP file
+    #
+    def __init__ (self, directory, backup):
+        self._directory = directory
+        self._fingerprint = Snapshot.fingerprint (backup)
+
+        #
+        # Month key and invoice states of the loaded snapshot (invoice id, state)
+        #
+        self._month = None
+        self._state = {}
+
+        #
+        # 'True' if the loaded snapshot has been written for the same backup content
+        #
+        self._trusted = False
+
+        #
+        # Content digests of all processed invoices (invoice id, digest)
+        #
+        self._digests = {}
+
+        #
+        # Payment history digest as (month key, hex digest of the payments before that month)
+        #
+        self._history = None
+
+    #
+    # Compute fingerprint of the raw backup content relevant for the allocation
+    #
+    # @param filename Name of the backup ZIP file
+    # @return Hex digest over the CSV files of the covered tables
+    #
+    @staticmethod
+    def fingerprint (filename):
+        fingerprint = hashlib.sha256 ()
+
+        with zipfile.ZipFile (filename) as archive:
+            for entry in sorted (archive.namelist ()):
+                if any (entry.endswith (name + '.csv') for name in Snapshot.tables):
+                    fingerprint.update (entry.encode ('utf-8'))
+
+                    with archive.open (entry, 'r') as file:
+                        for block in iter (lambda: file.read (1 << 20), b''):
+                            fingerprint.update (block)
+
+        return fingerprint.hexdigest ()
+
+    #
+    # Compute chained digest of the tax table and of all payments before a month
+    #
+    # @param database Database we are working with
+    # @param month    Month key the history ends before
+    # @return Hex digest which can be extended month by month via 'extend ()'
+    #
+    @staticmethod
+    def history (database, month):
+        history = hashlib.sha256 ()
+
+        for tax_id in database.range ('tax'):
+            history.update (repr ((tax_id, database.get ('tax', tax_id, 'tax'))).encode ('utf-8'))
+
+        history = history.hexdigest ()
+
+        for (payment_month,) in database.values ('payments', ('date_month',)):
+            if payment_month < month:
+                history = Snapshot.extend (history, database, payment_month)
+
+        return history
+
+    #
+    # Extend chained history digest by the payments of a month
+    #
+    # @param history  Hex digest as returned by 'history ()'
+    # @param database Database we are working with
+    # @param month    Month key of the payments to add
+    # @return Hex digest including the payments of the month. Months without any
+    #         payment leave the digest unchanged.
+    #
+    @staticmethod
+    def extend (history, database, month):
+        payment_ids = database.lookup ('payments', ('date_month',), (month,))
+
+        if not payment_ids:
+            return history
+
+        digest = hashlib.sha256 (history.encode ('utf-8'))
+
+        for payment_id in payment_ids:
+            digest.update (repr ([database.get ('payments', payment_id, key)
+                                  for key in Snapshot.payment_keys]).encode ('utf-8'))
+
+        return digest.hexdigest ()
+
+    #
+    # Return history digest of the payments before a month. The digest is only
+    # computed from scratch once and then extended month by month.
+    #
+    # @param database Database we are working with
+    # @param month    Month key the history ends before
+    #
+    def historyBefore (self, database, month):
+        if self._history is None or self._history[0] > month:
+            self._history = (month, Snapshot.history (database, month))
+
+        while self._history[0] < month:
+            self._history = (self._history[0] + 1, Snapshot.extend (self._history[1], database, self._history[0]))
+
+        return self._history[1]
+
+    #
+    # Return file name of the snapshot for the beginning of a month
+    #
+    def path (self, month):
+        year, month = keyToMonth (month)
+        return os.path.join (self._directory, 'snapshot-{:04d}-{:02d}.json'.format (year, month))
+
+    #
+    # Return month keys of all snapshots present up to a month
+    #
+    # @param month Month key of the latest snapshot of interest
+    # @return Ascending list of month keys
+    #
+    def months (self, month):
+        if not os.path.isdir (self._directory):
+            return []
+
+        months = []
+
+        for name in os.listdir (self._directory):
+            match = re.fullmatch (r'snapshot-(\d{4})-(\d{2})\.json', name)
+
+            if match is not None and monthKey (int (match.group (1)), int (match.group (2))) <= month:
+                months.append (monthKey (int (match.group (1)), int (match.group (2))))
+
+        return sorted (months)
+
+    #
+    # Load the latest valid snapshot up to the beginning of a month
+    #
+    # The payment history is only hashed if the backup content differs from
+    # the one the latest snapshot has been written for. It is then hashed in
+    # a single pass for all snapshot months.
+    #
+    # @param database Database we are working with
+    # @param month    Month key of the requested snapshot
+    # @return Month key of the loaded snapshot or 'None' if there is no valid snapshot
+    #
+    def load (self, database, month):
+        self._month = None
+        self._state = {}
+        self._trusted = False
+
+        months = self.months (month)
+        histories = None
+
+        for candidate in reversed (months):
+            with open (self.path (candidate), 'r') as file:
+                content = json.load (file)
+
+            if content['fingerprint'] == self._fingerprint:
+                self._history = (candidate, content['history'])
+                self._trusted = True
+
+            else:
+                if histories is None:
+                    histories = {key: self.historyBefore (database, key) for key in months}
+
+                if content['history'] != histories[candidate]:
+                    print ('Snapshot {} is outdated'.format (self.path (candidate)))
+                    continue
+
+            if candidate < month:
+                print ('Snapshot {} is used, applying the payments since'.format (self.path (candidate)))
+
+            self._month = candidate
+            self._state = content['invoices']
+            return candidate
+
+        return None
+
+    #
+    # Return month key of the loaded snapshot or 'None' if no snapshot has been loaded
+    #
+    def month (self):
+        return self._month
+
+    #
+    # Return the invoice states which can be taken over without any check
+    #
+    # @return Dictionary of (invoice id, state) items, empty unless the snapshot
+    #         has been written for the same backup content
+    #
+    def trusted (self):
+        if not self._trusted:
+            return {}
+
+        for invoice_id, state in self._state.items ():
+            self._digests[invoice_id] = state['digest']
+
+        return self._state
+
+    #
+    # Restore invoice allocation state from the loaded snapshot. Must be called
+    # before any payment has been applied to the invoice.
+    #
+    # @param invoice Freshly created invoice
+    # @return 'True' if the snapshot contained a matching state for the invoice
+    #
+    def restore (self, invoice):
+        digest = invoice.digest ()
+        self._digests[invoice._id] = digest
+
+        state = self._state.get (invoice._id)
+        if state is None or state['digest'] != digest:
+            return False
+
+        invoice.setState (state)
+        return True
+
+    #
+    # Write snapshot for the beginning of a month
+    #
+    # @param database Database we are working with
+    # @param month    Month key of the snapshot
+    # @param invoices Invoices (id, invoice) with all payments before that month applied
+    #
+    def save (self, database, month, invoices):
+        state = {}
+
+        for invoice_id, invoice in invoices.items ():
+            state[invoice_id] = dict (invoice.getState (), digest=self._digests[invoice_id])
+
+        os.makedirs (self._directory, exist_ok=True)
+
+        with open (self.path (month) + '.tmp', 'w') as file:
+            json.dump ({'fingerprint': self._fingerprint,
+                        'history'    : self.historyBefore (database, month),
+                        'invoices'   : state}, file)
+
+        os.replace (self.path (month) + '.tmp', self.path (month))
+
+
+#---------------------------------------------------------------------
+# CLASS AllocationLog
+#
+# This class keeps the allocation state of all invoices at the beginning
+# of a month together with the payments it results from. Each logged
+# payment is recorded with the debt parts it consumed, so a later run
+# continues from the logged states and has to allocate the payments not
+# seen before only. Because the debt is always consumed front to back,
+# the resulting state does not depend on the order the payments are
+# applied in. Invoices without new or exported payments are not touched
+# at all and keep their logged record. Their contents are checked against
+# the logged digest as soon as they are touched again.
+#
+# The log is a JSON lines file. Each run appends the month of the logged
+# states and one line per invoice with new payments only:
+#
+# {"month": <month key>}
+# {"invoice": <invoice id>, "digest": <content digest>, "open": <cents>,
+#  "debt": [[domain, tax, account, cents], ...], "payments": {<payment id>: [<cents>, <paid parts>]}}
+# {"invoice": <invoice id>, "open": <cents>, "debt": [...], "payments": {<new payment id>: [...]}}
+#
+# Lines with a digest start the history of an invoice from scratch, lines
+# without continue the history of the previous line of the same invoice.
+# The log is compacted to a single line per invoice when it has grown to
+# more than twice that size or if an earlier month is logged.
+#---------------------------------------------------------------------
+
+class AllocationLog:
+
+    #
+    # Constructor
+    #
+    # @param filename Name of the log file. Missing files are treated as empty log.
+    #
+    def __init__ (self, filename):
+        self._filename = filename
+
+        #
+        # Logged invoice records (invoice id, record) at the beginning of the month 'self._month'
+        #
+        self._month = None
+        self._invoices = {}
+
+        #
+        # Number of lines of the log file
+        #
+        self._lines = 0
+
+        #
+        # Payments not logged yet to be applied on top of the logged states (invoice id, payment ids)
+        #
+        self._new = None
+
+        #
+        # Invoices whose logged payments have been changed or removed since
+        #
+        self._stale = set ()
+
+        #
+        # Invoices with new, changed or exported payments
+        #
+        self._touched = set ()
+
+        #
+        # Invoices kept in the log without being touched
+        #
+        self._kept = set ()
+
+        #
+        # Content digests and logged payments of all restored or replayed invoices (invoice id, ...)
+        #
+        self._digests = {}
+        self._logged = {}
+
+        #
+        # 'True' if the log must be rewritten instead of appended to
+        #
+        self._compact = False
+
+        #
+        # Lines to be written and file mode ('a' for append, 'w' for compaction)
+        #
+        self._content = None
+        self._mode = None
+
+        if os.path.exists (filename):
+            with open (filename, 'r') as file:
+                lines = file.read ().splitlines ()
+
+            for number, line in enumerate (lines):
+                try:
+                    entry = json.loads (line)
+                except ValueError:
+
+                    #
+                    # The last line may have been cut off by an interrupted run. Its
+                    # payments are considered as not logged then and the log is
+                    # rewritten, so no line is appended to the cut off one.
+                    #
+                    if number == len (lines) - 1:
+                        self._compact = True
+                        break
+                    raise
+
+                if 'month' in entry:
+                    self._month = entry['month']
+
+                elif 'digest' in entry:
+                    self._invoices[entry.pop ('invoice')] = entry
+
+                else:
+                    record = self._invoices[entry['invoice']]
+                    record['open'] = entry['open']
+                    record['debt'] = entry['debt']
+                    record['payments'].update (entry['payments'])
+
+            self._lines = len (lines)
+
+    #
+    # Compare the logged payments with the payments of the database
+    #
+    # The payment columns are compared in a single pass. Payments before the
+    # first exported month which are not logged yet are collected per invoice.
+    # Invoices with changed or removed logged payments are marked as stale and
+    # have to be replayed. Must be called before 'createInvoices ()'.
+    #
+    # @param database    Database we are working with
+    # @param first_month Month key of the first exported month
+    # @param last_month  Month key of the last exported month
+    #
+    def prepare (self, database, first_month, last_month):
+        self._new = {}
+        self._stale = set ()
+        self._touched = set ()
+
+        #
+        # A state of a later month cannot be rolled back
+        #
+        if self._month is not None and self._month > first_month:
+            self._invoices = {}
+            self._compact = True
+
+        logged = {payment_id: invoice_id
+                  for invoice_id, record in self._invoices.items () for payment_id in record['payments']}
+
+        columns = [database.column ('payments', key) for key in ['id', 'invoice_id', 'amount', 'date_month', 'deleted']]
+
+        for payment_id, invoice_id, amount, payment_month, deleted in zip (*columns):
+            if deleted or not invoice_id:
+                continue
+
+            if payment_month >= first_month:
+                if payment_month <= last_month:
+                    self._touched.add (invoice_id)
+                continue
+
+            logged_invoice = logged.pop (payment_id, None)
+
+            if logged_invoice is None:
+                self._new.setdefault (invoice_id, []).append (payment_id)
+            elif logged_invoice != invoice_id or self._invoices[invoice_id]['payments'][payment_id][0] != amount:
+                self._stale.update ([invoice_id, logged_invoice])
+
+        #
+        # Logged payments which are deleted, moved behind the month or gone
+        #
+        self._stale.update (logged.values ())
+
+        self._touched.update (self._new.keys ())
+        self._touched.update (self._stale)
+
+        #
+        # New payments are applied in the same order as replayed
+        #
+        for payment_ids in self._new.values ():
+            payment_ids.sort (key=lambda payment_id: (dateOrder (database.get ('payments', payment_id, 'date')), payment_id))
+
+    #
+    # Keep invoice in the log without creating it, if it is not touched by this run
+    #
+    # @param invoice_id Id of the complete invoice
+    # @return 'True' if the invoice is kept in the log
+    #
+    def keep (self, invoice_id):
+        assert self._new is not None
+
+        if invoice_id not in self._invoices or invoice_id in self._touched:
+            return False
+
+        self._kept.add (invoice_id)
+        return True
+
+    #
+    # Restore invoice allocation state from the log and apply the payments not
+    # logged yet. Must be called before any payment has been applied to the invoice.
+    #
+    # @param database Database we are working with
+    # @param invoice  Freshly created invoice
+    # @return 'True' if the log contained a matching state for the invoice
+    #
+    def restore (self, database, invoice):
+        record = self._invoices.get (invoice._id)
+
+        #
+        # Invoices changed since the log has been written are detected via their content digest
+        #
+        if record is None or invoice._id in self._stale or invoice.digest () != record['digest']:
+            return False
+
+        invoice.setState (record)
+        invoice._events = []
+
+        self._digests[invoice._id] = record['digest']
+        self._logged[invoice._id] = record['payments']
+
+        for payment_id in self._new.get (invoice._id, []):
+            invoice.applyPayment (database, payment_id)
+
+        return True
+
+    #
+    # Start recording the history of an invoice replayed from scratch. Must be
+    # called before any payment has been applied to the invoice.
+    #
+    # @param invoice Freshly created invoice
+    #
+    def track (self, invoice):
+        invoice._events = []
+
+        self._digests[invoice._id] = invoice.digest ()
+        self._logged[invoice._id] = None
+
+    #
+    # Record the invoice states at the beginning of a month. Only invoices with
+    # new payments are added to the log. Created invoices which are not tracked
+    # by the log are left out.
+    #
+    # @param database Database we are working with
+    # @param invoices Invoices (id, invoice) with all payments before that month applied
+    # @param month    Month key of the recorded states
+    #
+    def record (self, database, invoices, month):
+        records = {invoice_id: self._invoices[invoice_id] for invoice_id in self._kept}
+        entries = []
+
+        for invoice_id, invoice in invoices.items ():
+            if invoice._events is None:
+                continue
+
+            payments = {payment_id: [database.get ('payments', payment_id, 'amount'), parts]
+                        for payment_id, parts in invoice._events}
+
+            #
+            # Restored invoices continue their logged history
+            #
+            if self._logged[invoice_id] is not None:
+                if not payments:
+                    records[invoice_id] = self._invoices[invoice_id]
+                    continue
+
+                entries.append (dict (invoice.getState (), invoice=invoice_id, payments=payments))
+
+                logged = dict (self._logged[invoice_id])
+                logged.update (payments)
+                payments = logged
+
+            else:
+                entries.append (dict (invoice.getState (), invoice=invoice_id,
+                                      digest=self._digests[invoice_id], payments=payments))
+
+            records[invoice_id] = dict (invoice.getState (), digest=self._digests[invoice_id], payments=payments)
+
+        if self._compact or self._lines + len (entries) + 1 > 2 * (len (records) + 1):
+            self._mode = 'w'
+            self._content = [{'month': month}] + [dict (record, invoice=invoice_id) for invoice_id, record in records.items ()]
+
+        else:
+            self._mode = 'a'
+            self._content = ([{'month': month}] if month != self._month else []) + entries
+
+    #
+    # Write the recorded invoice states. Compacted logs replace the previous log content.
+    #
+    def save (self):
+        if not self._content:
+            return
+
+        directory = os.path.dirname (self._filename)
+        if directory:
+            os.makedirs (directory, exist_ok=True)
+
+        lines = ''.join (json.dumps (entry) + '\n' for entry in self._content)
+
+        if self._mode == 'a':
+            with open (self._filename, 'a') as file:
+                file.write (lines)
+
+        else:
+            with open (self._filename + '.tmp', 'w') as file:
+                file.write (lines)
+
+            os.replace (self._filename + '.tmp', self._filename)
+
+
+#---------------------------------------------------------------------
+# CLASS BackupDelta
+#
+# This class compares two backups of the same practice row by row. Rows
+# are matched by id and compared by a digest over their content, so a
+# later export can be restricted to the payments booked or changed since
+# the previous backup.
+#---------------------------------------------------------------------
+
+class BackupDelta:
+
+    #
+    # Compared tables: invoices, payments and the invoice line items
+    #
+    tables = ['invoices', 'payments'] + sorted (set (file for domain, file, conditions in Invoice.contents))
+
+    #
+    # Constructor
+    #
+    # @param old Database of the previous backup
+    # @param new Database of the current backup
+    #
+    def __init__ (self, old, new):
+        self._old = old
+        self._new = new
+
+        #
+        # Differing row ids per table (table name, set of ids)
+        #
+        self.added   = {}
+        self.changed = {}
+        self.removed = {}
+
+        for table in BackupDelta.tables:
+            old_digests = old.digests (table)
+            new_digests = new.digests (table)
+
+            self.added[table]   = set (id for id in new_digests if id not in old_digests)
+            self.removed[table] = set (id for id in old_digests if id not in new_digests)
+            self.changed[table] = set (id for id, digest in new_digests.items ()
+                                       if id in old_digests and old_digests[id] != digest)
+
+    #
+    # Return ids of the payments booked or changed since the previous backup
+    #
+    def payments (self):
+        return self.added['payments'] | self.changed['payments']
+
+    #
+    # Return ids of the invoices of the previous backup whose content changed
+    #
+    def invoices (self):
+        invoices = self.changed['invoices'] | self.removed['invoices']
+
+        for table in BackupDelta.tables[2:]:
+            invoices |= set (self._new.get (table, id, 'invoice_id') for id in self.added[table] | self.changed[table])
+            invoices |= set (self._old.get (table, id, 'invoice_id') for id in self.changed[table] | self.removed[table])
+
+        return invoices
+
+    #
+    # Warn about changes which affect rows already exported from the previous backup
+    #
+    # All payments of the previous backup up to the last exported month are
+    # considered as exported. Changes to these payments, to the invoices they
+    # belong to or payments inserted before them cannot be covered by a delta
+    # export and have to be corrected manually.
+    #
+    # @param first_month Month key of the first exported month
+    # @param last_month  Month key of the last exported month
+    #
+    def check (self, first_month, last_month):
+        old = self._old
+        new = self._new
+
+        def exported (payment_id):
+            return 0 <= old.get ('payments', payment_id, 'date_month') <= last_month and \
+                   not old.get ('payments', payment_id, 'deleted')
+
+        def number (invoice_id):
+            if new.contains ('invoices', invoice_id):
+                return new.get ('invoices', invoice_id, 'number')
+            if old.contains ('invoices', invoice_id):
+                return old.get ('invoices', invoice_id, 'number')
+            return invoice_id
+
+        #
+        # Exported payments changed or deleted since, with the earliest changed
+        # payment position per invoice (invoice id, (date, payment id))
+        #
+        first = {}
+
+        for payment_id in sorted (self.changed['payments'] | self.removed['payments']):
+            if exported (payment_id):
+                warnings.warn ('Bereits exportierte Zahlung {zahlung} vom {datum} wurde nachträglich geändert oder gelöscht.'
+                               .format (zahlung=payment_id, datum=formatDate (old.get ('payments', payment_id, 'date'), '-')),
+                               RuntimeWarning)
+
+        for database, ids in [(old, self.changed['payments'] | self.removed['payments']),
+                              (new, self.changed['payments'] | self.added['payments'])]:
+            for payment_id in ids:
+                invoice_id = database.get ('payments', payment_id, 'invoice_id')
+                position = (dateOrder (database.get ('payments', payment_id, 'date')), payment_id)
+
+                if invoice_id:
+                    first[invoice_id] = min (first.get (invoice_id, position), position)
+
+        #
+        # Payments booked late for months already exported
+        #
+        for payment_id in sorted (self.added['payments']):
+            month = new.get ('payments', payment_id, 'date_month')
+
+            if 0 <= month < first_month and not new.get ('payments', payment_id, 'deleted'):
+                year, month = keyToMonth (month)
+                warnings.warn ('Zahlung {zahlung} wurde nachträglich für den bereits exportierten Monat {monat:02d}/{jahr} gebucht.'
+                               .format (zahlung=payment_id, monat=month, jahr=year), RuntimeWarning)
+
+        #
+        # Invoices changed after some of their payments have been exported
+        #
+        for invoice_id in sorted (self.invoices ()):
+            if any (exported (payment_id) for payment_id in old.lookup ('payments', ('invoice_id',), (invoice_id,))):
+                warnings.warn ('Rechnung {rechnung} mit bereits exportierten Zahlungen wurde nachträglich geändert.'
+                               .format (rechnung=number (invoice_id)), RuntimeWarning)
+
+        #
+        # Unchanged exported payments whose allocation shifted because earlier
+        # payments of the same invoice changed
+        #
+        changed = self.changed['payments'] | self.removed['payments']
+
+        for invoice_id in sorted (first):
+            for payment_id in old.lookup ('payments', ('invoice_id',), (invoice_id,)):
+                position = (dateOrder (old.get ('payments', payment_id, 'date')), payment_id)
+
+                if payment_id not in changed and exported (payment_id) and position > first[invoice_id]:
+                    warnings.warn ('Aufteilung der bereits exportierten Zahlung {zahlung} auf Rechnung {rechnung} '
+                                   'hat sich durch frühere Zahlungen verschoben.'
+                                   .format (zahlung=payment_id, rechnung=number (invoice_id)), RuntimeWarning)
+
+
+#---------------------------------------------------------------------
+# CLASS DatevEntry
+#---------------------------------------------------------------------
+
+#
+# Class representing a single DATEV file entry
+#
+# Valid fields are:
+#
+# - invoice_id       - Id of the invoice
+# - invoice_date     - Date of the invoice
+# - payment_id       - Id of the payment itself
+# - payment_date     - Date of payment
+# - payment_kind     - Way of payment (cash, card, ...)
+# - payment_type     - Type of payment (transfer, ...)
+# - item_kind        - Kind of item applied/sold
+# - item_date        - Date the item was applied/sold
+# - item_description - Description of the item
+# - item_tax         - Tax of the item
+# - customer_id      - Id of the customer
+# - amount           - Amount of money
+# - remarks          - Payment remarks
+# - responsible      - Name of the responsible person
+# - account_from     - Account where the money came from
+# - account_to       - Account where the money goes to
+class DatevEntry:
+
+    __slots__ = ['_id', '_invoice_id', '_invoice_date', '_payment_id', '_payment_date', '_payment_kind',
+                 '_item_kind', '_item_date', '_item_description', '_item_tax', '_customer_id', '_amount',
+                 '_remarks', '_responsible', '_account_from', '_account_to', '_payment_type']
+
+    #
+    # Constructor (all kinds of payments)
+    #
+    # @param database   Database we are working with
+    # @param payment_id Id of the payment to be processed
     #
     def __init__ (self, database, payment_id):
 
         #
-        # The payment type is not known yet. Setup common fields only.
+        # The payment type is not known yet. Setup common fields only.
+        #
+        self._id               = payment_id
+        self._invoice_id       = ''
+        self._invoice_date     = ''
+        self._payment_id       = payment_id
+        self._payment_date     = self.get (database, 'date')
+        self._payment_kind     = self.get (database, 'method')
+        self._item_kind        = self.get (database, 'paymenttype')
+        self._item_date        = self._payment_date
+        self._item_description = self.get (database, 'notes')
+        self._item_tax         = ''
+        self._customer_id      = ''
+        self._amount           = self.get (database, 'amount')
+        self._remarks          = ''
+        self._responsible      = self.get (database, 'username')
+        self._account_from     = Accounts.Null
+        self._account_to       = Accounts.Null
+        self._payment_type     = ''
+
+    #
+    # Setup invoice based payment
+    #
+    # @param invoice_id    Id of the invoice the payment belongs to
+    # @param configuration Paid invoice debt part
+    #
+    def setupInvoiceEntry (self, database, invoice_id, configuration):
+        self._invoice_id = database.get ('invoices', invoice_id, 'number')
+        self._invoice_date = database.get ('invoices', invoice_id, 'date')
+        self._customer_id = database.get ('invoices', invoice_id, 'client_id')
+
+        self._item_tax = database.get ('tax', configuration.tax, 'tax')
+        self._item_kind = Domains.kinds[configuration.domain]
+
+        self._item_description = 'Rechnung {}'.format (self._invoice_id)
+        self._amount = configuration.sum
+        self._payment_type = "Umsatz"
+        self._account_from = configuration.account
+
+        #
+        # Payments via bank transfer are directly assigned to the bank account.
+        # Everything else, including EC card payments,  goes into the main account.
+        #
+        if self._payment_kind == 'bill':
+            self._account_to = Accounts.Transfer
+        else:
+            self._account_to = Accounts.Main
+
+    #
+    # Setup non invoice payment
+    #
+    def setupNonInvoiceEntry (self):
+        if self._item_kind.lower ().startswith ('geld auf bank'):
+            self._account_from     = Accounts.Bank
+            self._account_to       = Accounts.Main
+            self._payment_type     = 'Umbuchung'
+            self._item_kind        = 'Einzahlung'
+            self._item_description = 'Geld auf Bank'
+        else:
+            self._account_from = Accounts.Null
+            self._account_to   = Accounts.Main
+            self._payment_type = 'Barentnahme'
+            self._remarks      = self._item_kind
+            self._item_kind    = 'Barausgabe'
+
+
+    #
+    # Setup counter entry for moving another payment via ec card onto a
+    # special account for accounting purposes
+    #
+    def setupECCounterEntry (self, database, payment_id, invoice_id):
+        if invoice_id != '':
+            self._invoice_id       = database.get ('invoices', invoice_id, 'number')
+            self._invoice_date     = database.get ('invoices', invoice_id, 'date')
+            self._customer_id      = database.get ('invoices', invoice_id, 'client_id')
+            self._item_description = 'Übertrag EC-Karten-Zahlung {}'.format (self._invoice_id)
+            self._remarks          = 'Übertrag EC-Karten-Zahlung'
+        else:
+            self._invoice_id       = None
+            self._invoice_date     = dateToString (database.get ('payments', payment_id, 'date'))
+            self._customer_id      = None
+            self._item_description = 'Übertrag EC-Karten-Zahlung OHNE RECHNUNG (z.B. Mahngebühr)'
+            self._remarks          = 'Übertrag EC-Karten-Zahlung: {}' \
+                                     .format (database.get ('payments', payment_id, 'notes'))
+
+        self._amount           = -self._amount
+        self._account_from     = Accounts.EC
+        self._account_to       = Accounts.Main
+        self._payment_type     = 'Umbuchung'
+        self._item_kind        = 'Umbuchung'
+
+    #
+    # Return shallow copy sharing the common payment fields
+    #
+    def __copy__ (self):
+        entry = DatevEntry.__new__ (DatevEntry)
+
+        for key in DatevEntry.__slots__:
+            setattr (entry, key, getattr (self, key))
+
+        return entry
+
+    #
+    # Query database for payment entry (shortcut)
+    #
+    def get (self, database, key):
+        return database.get ('payments', self._id, key)
+
+    #
+    # Row template and the fixed output vector slots of the exported fields, resolved
+    # once from the column mapping
+    #
+    row_template = [''] * len (datev_columns)
+
+    slots = tuple (datev_column_mapping[id] - 1 for id in
+                   ['umsatz', 'soll_haben', 'konto', 'gegenkonto', 'bu_schluessel', 'belegdatum',
+                    'buchungstext', 'eu_steuersatz', 'zahlweise', 'buchungstyp', 'gesellschaftername',
+                    'sachverhalt'])
+
+    info_slots = tuple ((datev_column_mapping['beleginfo_art_{}'.format (i)] - 1,
+                         datev_column_mapping['beleginfo_inhalt_{}'.format (i)] - 1) for i in range (1, 8))
+
+    #
+    # BU-Schluessel of the supported tax rates and of the already seen tax texts
+    #
+    tax_rates = {19.0: 3, 7.0: 2, 0.0: None}
+    tax_keys  = {'': None}
+
+    #
+    # DATEV 'Zahlweise' of the payment kinds
+    #
+    payment_kinds = {'ec': 'EC-Karte', 'cash': 'Bar', 'bill': 'Überweisung'}
+
+    #
+    # Return BU-Schluessel matching the tax text of the tax table
+    #
+    @staticmethod
+    def getTaxKey (tax):
+        if tax not in DatevEntry.tax_keys:
+            rate = float (tax)
+
+            if rate not in DatevEntry.tax_rates:
+                raise ValueError ("Unknown tax level '{}'".format (tax))
+
+            DatevEntry.tax_keys[tax] = DatevEntry.tax_rates[rate]
+
+        return DatevEntry.tax_keys[tax]
+
+    #
+    # Convert entry into vector of DATEV rows
+    #
+    # @return Vector containing all DATEV colunms for this entry
+    #
+    def toDatev (self):
+        (umsatz, soll_haben, konto, gegenkonto, bu_schluessel, belegdatum, buchungstext,
+         eu_steuersatz, zahlweise, buchungstyp, gesellschaftername, sachverhalt) = self.slots
+
+        row = self.row_template.copy ()
+
+        row[umsatz]        = formatAmount (abs (self._amount))
+        row[soll_haben]    = 'S' if self._amount < 0 else 'H'
+        row[konto]         = self._account_from
+        row[gegenkonto]    = self._account_to
+        row[bu_schluessel] = self.getTaxKey (self._item_tax)
+
+        row[belegdatum]    = formatDate (self._payment_date)
+        row[buchungstext]  = self._item_description
+        row[eu_steuersatz] = self._item_tax
+
+        if self._payment_kind not in self.payment_kinds:
+            raise ValueError ("Unknown payment type '{}'".format (self._payment_kind))
+
+        row[zahlweise]          = self.payment_kinds[self._payment_kind]
+        row[buchungstyp]        = self._payment_type
+        row[gesellschaftername] = self._responsible
+        row[sachverhalt]        = self._item_kind
+
+        infos = self.info_slots
+
+        if self._invoice_id:
+            row[infos[0][0]] = 'Rechnungsnummer'
+            row[infos[0][1]] = self._invoice_id
+
+        if self._invoice_date:
+            row[infos[1][0]] = 'Rechnungsdatum'
+            row[infos[1][1]] = self._invoice_date
+
+        if self._payment_id:
+            row[infos[2][0]] = 'Vorgangsnummer'
+            row[infos[2][1]] = self._payment_id
+
+        if self._item_kind:
+            row[infos[3][0]] = 'Typ'
+            row[infos[3][1]] = self._item_kind
+
+        if self._customer_id:
+            row[infos[4][0]] = 'Kundennummer'
+            row[infos[4][1]] = self._customer_id
+
+        if self._remarks:
+            row[infos[5][0]] = 'Bemerkungen'
+            row[infos[5][1]] = self._remarks
+
+        if self._item_date:
+            row[infos[6][0]] = 'Leistungsdatum'
+            row[infos[6][1]] = formatDate (self._item_date)
+
+        return row
+
+
+#---------------------------------------------------------------------
+# CLASS MonthExport
+#
+# This class processes the payments of a month in a single pass. Each
+# payment is read once and feeds the invoice allocation, the DATEV entries,
+# the crosscheck rows and the turnover/petty cash totals. The DATEV entries
+# are generated lazily, so they can be written while the pass proceeds.
+#---------------------------------------------------------------------
+
+class MonthExport:
+
+    #
+    # Constructor
+    #
+    # @param database Database we are working with
+    # @param year     Exported year
+    # @param month    Exported month
+    # @param invoices Invoices as returned by 'createInvoices ()' for the same month. They
+    #                 are reduced by the payments of the month. If 'None', no DATEV entries
+    #                 are generated.
+    # @param payments Set of payment ids the DATEV entries are generated for. All other
+    #                 payments still reduce the invoices and count in the totals. If 'None',
+    #                 the entries of all payments are generated.
+    #
+    def __init__ (self, database, year, month, invoices=None, payments=None):
+
+        self._database = database
+        self._month    = monthKey (year, month)
+        self._invoices = invoices
+        self._payments = payments
+        self._done     = False
+
+        #
+        # Totals of the pass in cents
+        #
+        self.turnover = 0
+        self.cash     = 0
+
+        self._ec_payments   = []
+        self._bill_payments = []
+
+    #
+    # Generate the DATEV entries of the month while processing its payments
+    #
+    # The totals and crosscheck rows are complete as soon as the generator
+    # is exhausted. The pass can be run once only.
+    #
+    # @return Generator of DATEV entries in export order
+    #
+    def entries (self):
+        assert not self._done
+
+        #
+        # The month index delivers the payments of that month only
+        #
+        for payment_id in self._database.lookup ('payments', ('date_month',), (self._month,)):
+            if self._payments is None or payment_id in self._payments:
+                yield from self.addPayment (payment_id)
+            else:
+                for entry in self.addPayment (payment_id):
+                    pass
+
+        self._done = True
+
+    #
+    # Run the complete pass without keeping the DATEV entries
+    #
+    # @return The export itself
+    #
+    def run (self):
+        for entry in self.entries ():
+            pass
+
+        return self
+
+    #
+    # Process a single payment of the month
+    #
+    # @param payment_id Id of the payment
+    # @return Generator of the DATEV entries of the payment
+    #
+    def addPayment (self, payment_id):
+
+        database = self._database
+
+        #
+        # Skip cancelled payments at all
+        #
+        if database.get ('payments', payment_id, 'deleted'):
+            return
+
+        amount     = database.get ('payments', payment_id, 'amount')
+        method     = database.get ('payments', payment_id, 'method')
+        invoice_id = database.get ('payments', payment_id, 'invoice_id')
+
+        #
+        # Totals: petty cash and invoice based turnover
+        #
+        if method == 'cash':
+            self.cash += amount
+
+        if invoice_id:
+            self.turnover += amount
+
+        #
+        # Crosscheck rows for EC card and bank transfer payments
+        #
+        if method == 'ec' or method == 'bill':
+            bill_number = None
+            name = None
+
+            if invoice_id:
+                bill_number = database.get ('invoices', invoice_id, 'number')
+                client_id = database.get ('invoices', invoice_id, 'client_id')
+
+                if client_id:
+                    name = database.get ('clients', client_id, 'lastname')
+
+            row = [formatDate (database.get ('payments', payment_id, 'date'), '-'),
+                   formatAmount (abs (amount)),
+                   'EC Karte' if method == 'ec' else 'Überweisung',
+                   bill_number,
+                   name]
+
+            if method == 'ec':
+                self._ec_payments.append (row)
+            else:
+                self._bill_payments.append (row)
+
+        #
+        # Accountants tax application cannot process payments with 0€ amount
+        #
+        if self._invoices is None or amount == 0:
+            return
+
+        #
+        # All entries of the payment share the common payment fields
+        #
+        payment = DatevEntry (database, payment_id)
+
+        #
+        # Case 1: Invoice based payment
+        #
+        if invoice_id:
+            assert invoice_id in self._invoices
+
+            #
+            # The invoice debt is reduced by the payment just made. The paid parts
+            # are returned in this process and will be used to generate a single
+            # DATEV entry for each part.
+            #
+            for part in self._invoices[invoice_id].applyPayment (database, payment_id):
+                entry = copy.copy (payment)
+                entry.setupInvoiceEntry (database, invoice_id, part)
+                yield entry
+
+        #
+        # Case 2: Non-invoice based payment
+        #
+        else:
+            entry = copy.copy (payment)
+            entry.setupNonInvoiceEntry ()
+            yield entry
+
+        #
+        # In case of EC card payments, setup additional counter entry. Exception exists, like
+        # 'Mahngebuehren' which have to be entered manually and separately without having an
+        # invoice.
         #
-        self._id               = payment_id
-        self._invoice_id       = ''
-        self._invoice_date     = ''
-        self._payment_id       = payment_id
-        self._payment_date     = stringToDate (self.get (database, 'date'))
-        self._payment_kind     = self.get (database, 'method')
-        self._item_kind        = self.get (database, 'paymenttype')
-        self._item_date        = self._payment_date
-        self._item_description = self.get (database, 'notes')
-        self._item_tax         = ''
-        self._customer_id      = ''
-        self._amount           = roundEuro (float (self.get (database, 'amount')))
-        self._remarks          = ''
-        self._responsible      = self.get (database, 'username')
-        self._account_from     = Accounts.Null
-        self._account_to       = Accounts.Null
-        self._payment_type     = ''
+        if method == 'ec':
+            entry = copy.copy (payment)
+            entry.setupECCounterEntry (database, payment_id, invoice_id)
+            yield entry
 
     #
-    # Setup invoice based payment
+    # Return crosscheck rows of the month, EC card payments first
     #
-    # @param invoice_id    Id of the invoice the payment belongs to
-    # @param configuration Payment configuration as (domain, tax, account, sum) dictionary
+    # @return List of crosscheck rows (without header)
     #
-    def setupInvoiceEntry (self, database, invoice_id, configuration):
-        self._invoice_id = database.get ('invoices', invoice_id, 'number')
-        self._invoice_date = database.get ('invoices', invoice_id, 'date')
-        self._customer_id = database.get ('invoices', invoice_id, 'client_id')
+    def crosscheck (self):
+        assert self._done
+        return sorted (self._ec_payments, key=lambda row: row[0]) + \
+               sorted (self._bill_payments, key=lambda row: row[0])
 
-        self._item_tax = database.get ('tax', configuration['tax'], 'tax')
 
-        if configuration['domain'] == 'services':
-            self._item_kind = 'Leistungen'
-        elif configuration['domain'] == 'products':
-            self._item_kind = 'Produkte'
-        elif configuration['domain'] == 'medication':
-            self._item_kind = 'Medikamente (abgegeben)'
-        elif configuration['domain'] == 'medication_applied':
-            self._item_kind = 'Medikamente (angewendet)'
-        else:
-            self._item_kind = configuration['domain']
+#---------------------------------------------------------------------
+# CLASS Totals
+#
+# This class keeps the monthly turnover and cash totals of all payments,
+# computed at once from the typed payment columns. The petty cash balance
+# before each month is a prefix sum over the monthly cash totals.
+#---------------------------------------------------------------------
 
-        self._item_description = 'Rechnung {}'.format (self._invoice_id)
-        self._amount = configuration['sum']
-        self._payment_type = "Umsatz"
-        self._account_from = configuration['account']
+class Totals:
+
+    #
+    # Constructor
+    #
+    # @param database Database we are working with
+    #
+    def __init__ (self, database):
+
+        months      = database.column ('payments', 'date_month')
+        amounts     = database.column ('payments', 'amount')
+        deleted     = database.column ('payments', 'deleted')
+        methods     = database.column ('payments', 'method')
+        invoice_ids = database.column ('payments', 'invoice_id')
 
         #
-        # Payments via bank transfer are directly assigned to the bank account.
-        # Everything else, including EC card payments,  goes into the main account.
+        # Monthly totals in cents, starting with the month of the first payment.
+        # Cash payments without date count for the balance of every month.
         #
-        if self._payment_kind == 'bill':
-            self._account_to = Accounts.Transfer
+        self._first = min ((month for month in months if month >= 0), default=0)
+        count = max (months, default=self._first) - self._first + 1
+
+        if np is not None:
+            month  = np.asarray (months) - self._first
+            amount = np.asarray (amounts)
+            valid  = np.array (deleted) == ''
+
+            cash    = valid & (np.array (methods) == 'cash')
+            invoice = valid & (np.array (invoice_ids) != '')
+            dated   = month >= 0
+
+            self._turnover = self.sumMonths (month[invoice & dated], amount[invoice & dated], count)
+            self._cash     = self.sumMonths (month[cash & dated], amount[cash & dated], count)
+            undated        = int (amount[cash & ~dated].sum ())
+
+            self._petty_cash = (np.concatenate (([0], np.cumsum (self._cash))) + undated).tolist ()
+            self._turnover   = self._turnover.tolist ()
+            self._cash       = self._cash.tolist ()
+
         else:
-            self._account_to = Accounts.Main
+            self._turnover = [0] * count
+            self._cash     = [0] * count
+            undated        = 0
+
+            for month, amount, deleted, method, invoice_id in zip (months, amounts, deleted, methods, invoice_ids):
+                if not deleted:
+                    if month < 0:
+                        if method == 'cash':
+                            undated += amount
+                    else:
+                        if method == 'cash':
+                            self._cash[month - self._first] += amount
+                        if invoice_id:
+                            self._turnover[month - self._first] += amount
+
+            self._petty_cash = [undated]
+            for cash in self._cash:
+                self._petty_cash.append (self._petty_cash[-1] + cash)
 
     #
-    # Setup non invoice payment
+    # Sum up amounts per month
     #
-    def setupNonInvoiceEntry (self):
-        if self._item_kind.lower ().startswith ('geld auf bank'):
-            self._account_from     = Accounts.Bank
-            self._account_to       = Accounts.Main
-            self._payment_type     = 'Umbuchung'
-            self._item_kind        = 'Einzahlung'
-            self._item_description = 'Geld auf Bank'
-        else:
-            self._account_from = Accounts.Null
-            self._account_to   = Accounts.Main
-            self._payment_type = 'Barentnahme'
-            self._remarks      = self._item_kind
-            self._item_kind    = 'Barausgabe'
+    # @param months  Array of month indices relative to the first month
+    # @param amounts Array of amounts in cents
+    # @param count   Number of months
+    # @return Array of monthly sums in cents
+    #
+    @staticmethod
+    def sumMonths (months, amounts, count):
+        sums = np.zeros (count, dtype=np.int64)
+        np.add.at (sums, months, amounts)
+        return sums
 
+    #
+    # Return invoice based turnover of a month in cents
+    #
+    # @param month Month key
+    #
+    def turnover (self, month):
+        index = month - self._first
+        return self._turnover[index] if index >= 0 and index < len (self._turnover) else 0
 
     #
-    # Setup counter entry for moving another payment via ec card onto a
-    # special account for accounting purposes
+    # Return sum of the cash payments of a month in cents
     #
-    def setupECCounterEntry (self, database, payment_id, invoice_id):
-        if invoice_id != '':
-            self._invoice_id       = database.get ('invoices', invoice_id, 'number')
-            self._invoice_date     = database.get ('invoices', invoice_id, 'date')
-            self._customer_id      = database.get ('invoices', invoice_id, 'client_id')
-            self._item_description = 'Übertrag EC-Karten-Zahlung {}'.format (self._invoice_id)
-            self._remarks          = 'Übertrag EC-Karten-Zahlung'
-        else:
-            self._invoice_id       = None
-            self._invoice_date     = database.get ('payments', payment_id, 'date')
-            self._customer_id      = None
-            self._item_description = 'Übertrag EC-Karten-Zahlung OHNE RECHNUNG (z.B. Mahngebühr)'
-            self._remarks          = 'Übertrag EC-Karten-Zahlung: {}' \
-                                     .format (database.get ('payments', payment_id, 'notes'))
+    # @param month Month key
+    #
+    def cash (self, month):
+        index = month - self._first
+        return self._cash[index] if index >= 0 and index < len (self._cash) else 0
 
-        self._amount           = -1.0 * self._amount
-        self._account_from     = Accounts.EC
-        self._account_to       = Accounts.Main
-        self._payment_type     = 'Umbuchung'
-        self._item_kind        = 'Umbuchung'
+    #
+    # Return petty cash balance before a month in cents
+    #
+    # @param month Month key
+    #
+    def pettyCash (self, month):
+        return self._petty_cash[min (max (month - self._first, 0), len (self._petty_cash) - 1)]
+
+
+#---------------------------------------------------------------------
+# CLASS CashBook
+#
+# This class keeps the cash book ('Kassenbuch') of the petty cash. All cash
+# payments are summed up per period and movement kind at once, the running
+# balances are prefix sums over the period movements.
+#---------------------------------------------------------------------
+
+class CashBook:
 
     #
-    # Query database for payment entry (shortcut)
+    # Cash book table columns
     #
-    def get (self, database, key):
-        return database.get ('payments', self._id, key)
+    columns = ['Zeitraum', 'Anfangsbestand', 'Einnahmen', 'Barentnahme', 'Geld auf Bank', 'Endbestand']
 
     #
-    # Get DATEV output vector column index matching a column id
+    # Movement kinds, matching the classification of the DATEV entries
     #
-    @staticmethod
-    def getColumn (id):
-        assert id in datev_column_mapping
-        return datev_column_mapping[id] - 1
+    Receipts    = 0
+    Withdrawals = 1
+    Deposits    = 2
 
     #
-    # Convert entry into vector of DATEV rows
+    # Constructor
     #
-    # @return Vector containing all DATEV colunms for this entry
+    # @param database Database we are working with
+    # @param daily    If 'True', the cash book is kept per day instead of per month
     #
-    def toDatev (self):
-        row = [''] * len (datev_columns)
-
-        row[self.getColumn ('umsatz')]        = locale.format ("%.2f", abs (self._amount))
-        row[self.getColumn ('soll_haben')]    = 'S' if self._amount < 0 else 'H'
-        row[self.getColumn ('konto')]         = self._account_from
-        row[self.getColumn ('gegenkonto')]    = self._account_to
-
-        if not self._item_tax:
-            row[self.getColumn ('bu_schluessel')] = None
-        elif float (self._item_tax) == 19.0:
-            row[self.getColumn ('bu_schluessel')] = 3
-        elif float (self._item_tax) == 7.0:
-            row[self.getColumn ('bu_schluessel')] = 2
-        elif float (self._item_tax) == 0.0:
-            row[self.getColumn ('bu_schluessel')] = None
-        else:
-            raise "Unknown tax level '{}'".format (self._item_tax)
-
-        row[self.getColumn ('belegdatum')]    = self._payment_date.strftime ('%d%m%Y')
-        row[self.getColumn ('buchungstext')]  = self._item_description
-        row[self.getColumn ('eu_steuersatz')] = self._item_tax
-
-        if self._payment_kind == 'ec':
-            row[self.getColumn ('zahlweise')] = 'EC-Karte'
-        elif self._payment_kind == 'cash':
-            row[self.getColumn ('zahlweise')] = 'Bar'
-        elif self._payment_kind == 'bill':
-            row[self.getColumn ('zahlweise')] = 'Überweisung'
+    def __init__ (self, database, daily=False):
+
+        self._daily = daily
+
+        amounts     = database.column ('payments', 'amount')
+        deleted     = database.column ('payments', 'deleted')
+        methods     = database.column ('payments', 'method')
+        invoice_ids = database.column ('payments', 'invoice_id')
+        kinds       = database.column ('payments', 'paymenttype')
+
+        #
+        # Period of each payment as month key or day number, -1 for payments without date
+        #
+        if daily:
+            periods = [date.toordinal () if date is not None else -1
+                       for date in database.column ('payments', 'date')]
         else:
-            raise "Unknown payment type '{}'".format (self._payment_kind)
+            periods = database.column ('payments', 'date_month')
 
-        row[self.getColumn ('buchungstyp')]        = self._payment_type
-        row[self.getColumn ('gesellschaftername')] = self._responsible
-        row[self.getColumn ('sachverhalt')]        = self._item_kind
+        self._first = min ((period for period in periods if period >= 0), default=0)
+        count = max (periods, default=self._first) - self._first + 1
 
-        if self._invoice_id:
-            row[self.getColumn ('beleginfo_art_1')]    = 'Rechnungsnummer'
-            row[self.getColumn ('beleginfo_inhalt_1')] = self._invoice_id
+        #
+        # Movements in cents (movement kind, period) and the balance before each period.
+        # Cash payments without date count for the balance of every period.
+        #
+        if np is not None:
+            period = np.asarray (periods) - self._first
+            amount = np.asarray (amounts)
 
-        if self._invoice_date:
-            row[self.getColumn ('beleginfo_art_2')]    = 'Rechnungsdatum'
-            row[self.getColumn ('beleginfo_inhalt_2')] = self._invoice_date
+            cash    = (np.array (deleted, dtype=str) == '') & (np.array (methods, dtype=str) == 'cash')
+            dated   = period >= 0
+            invoice = np.array (invoice_ids, dtype=str) != ''
+            deposit = ~invoice & np.char.startswith (np.char.lower (np.array (kinds, dtype=str)), 'geld auf bank')
 
-        if self._payment_id:
-            row[self.getColumn ('beleginfo_art_3')]    = 'Vorgangsnummer'
-            row[self.getColumn ('beleginfo_inhalt_3')] = self._payment_id
+            kind = np.where (invoice, CashBook.Receipts, np.where (deposit, CashBook.Deposits, CashBook.Withdrawals))
 
-        if self._item_kind:
-            row[self.getColumn ('beleginfo_art_4')]    = 'Typ'
-            row[self.getColumn ('beleginfo_inhalt_4')] = self._item_kind
+            movements = np.array ([Totals.sumMonths (period[mask], amount[mask], count)
+                                   for mask in (cash & dated & (kind == k) for k in range (3))])
 
-        if self._customer_id:
-            row[self.getColumn ('beleginfo_art_5')]    = 'Kundennummer'
-            row[self.getColumn ('beleginfo_inhalt_5')] = self._customer_id
+            self._movements = movements.tolist ()
+            self._balance = (np.concatenate (([0], np.cumsum (movements.sum (axis=0)))) +
+                             int (amount[cash & ~dated].sum ())).tolist ()
 
-        if self._remarks:
-            row[self.getColumn ('beleginfo_art_6')]    = 'Bemerkungen'
-            row[self.getColumn ('beleginfo_inhalt_6')] = self._remarks
+        else:
+            self._movements = [[0] * count for k in range (3)]
+            undated = 0
+
+            for period, amount, deleted, method, invoice_id, kind in \
+                    zip (periods, amounts, deleted, methods, invoice_ids, kinds):
+                if not deleted and method == 'cash':
+                    if period < 0:
+                        undated += amount
+                    elif invoice_id:
+                        self._movements[CashBook.Receipts][period - self._first] += amount
+                    elif kind.lower ().startswith ('geld auf bank'):
+                        self._movements[CashBook.Deposits][period - self._first] += amount
+                    else:
+                        self._movements[CashBook.Withdrawals][period - self._first] += amount
 
-        if self._item_date:
-            row[self.getColumn ('beleginfo_art_7')]    = 'Leistungsdatum'
-            row[self.getColumn ('beleginfo_inhalt_7')] = self._item_date.strftime ('%d%m%Y')
+            self._balance = [undated]
+            for i in range (count):
+                self._balance.append (self._balance[-1] + sum (movements[i] for movements in self._movements))
 
-        return row
+    #
+    # Return movement of a period in cents
+    #
+    # @param kind   Movement kind
+    # @param period Month key or day number
+    #
+    def movement (self, kind, period):
+        index = period - self._first
+        return self._movements[kind][index] if index >= 0 and index < len (self._movements[kind]) else 0
+
+    #
+    # Return petty cash balance before a period in cents
+    #
+    # @param period Month key or day number
+    #
+    def balance (self, period):
+        return self._balance[min (max (period - self._first, 0), len (self._balance) - 1)]
+
+    #
+    # Generate cash book rows for a range of months
+    #
+    # In daily mode, only days with cash movements get a row.
+    #
+    # @param first_month Month key of the first month
+    # @param last_month  Month key of the last month
+    # @return Generator of cash book rows (without header)
+    #
+    def rows (self, first_month, last_month):
+        if self._daily:
+            first = datetime.date (*keyToMonth (first_month), 1).toordinal ()
+            last  = datetime.date (*keyToMonth (last_month + 1), 1).toordinal () - 1
+        else:
+            first, last = first_month, last_month
+
+        for period in range (first, last + 1):
+            movements = [self.movement (kind, period) for kind in range (3)]
+
+            if self._daily:
+                if not any (movements):
+                    continue
+
+                label = formatDate (datetime.date.fromordinal (period), '.')
+            else:
+                label = '{:02d}/{}'.format (keyToMonth (period)[1], keyToMonth (period)[0])
+
+            yield [label, formatAmount (self.balance (period))] + \
+                  [formatAmount (movement) for movement in movements] + \
+                  [formatAmount (self.balance (period + 1))]
 
 
 #---------------------------------------------------------------------
-# MAIN
+# Export functions
+#
+# The functions below are the programmatic interface of the exporter. A
+# loaded database is never modified, so a long running process can keep
+# it in memory and serve any number of exports from it.
 #---------------------------------------------------------------------
 
 #
-# Configuration
+# Read backup ZIP file into a new database
 #
-# German locale for '1,23' like decimal points
+# @param filename Name of the backup ZIP file
+# @param jobs     Number of worker processes reading tables concurrently
+# @param context  'multiprocessing' context starting the worker processes, if not the default one
+# @return Database containing all registered tables
 #
-locale.setlocale (locale.LC_ALL, "de_DE.UTF-8")
+def loadBackup (filename, jobs=1, context=None):
+    database = Database ()
+    database.load (filename, jobs, context)
+    return database
 
 #
-# Database instance containg everything which was read
+# Generate the complete invoices with all payments before a month applied
 #
-database = Database ()
-
+# All payments before the month are replayed in a single pass in date order,
+# which applies the payments of each invoice in the same order as paid.
 #
-# Parse command line arguments
+# @param database Database we are working with
+# @param year     Year of the month
+# @param month    Month the invoice state is computed for
+# @param snapshot Loaded snapshot to restore the invoice states from, if any. States
+#                 of an earlier month get the payments since applied.
+# @param log      Allocation log prepared for the exported months to restore the
+#                 invoice states from and to track the applied payments in, if any.
+#                 Cannot be combined with a snapshot.
+# @return Dictionary of (invoice id, invoice) items. Invoices kept in the log are
+#         left out, they are not paid in the exported months.
 #
-parser = argparse.ArgumentParser ()
-
-parser.add_argument ('file',               type=str, help='Name of backup ZIP file')
-parser.add_argument ('-m', '--month',      type=int, help='Month (MM)')
-parser.add_argument ('-y', '--year',       type=int, help='Year (YYYY)')
-parser.add_argument ('-o', '--output',     type=str, help='Name of the output file')
-parser.add_argument ('-c', '--crosscheck', type=str, help='Name of the crosscheck file')
+def createInvoices (database, year, month, snapshot=None, log=None):
 
-args = parser.parse_args ()
+    assert snapshot is None or log is None
 
-filename   = args.file
-month      = args.month
-year       = args.year
-output     = args.output
-crosscheck = args.crosscheck
+    first_month = monthKey (year, month)
 
-assert len (filename) > 0
-assert month >= 1 and month <= 12
-assert year >= 2000
-assert len (output) > 0
-
-
-#
-# Read relevant CSV files from backup ZIP file into database
-#
-with zipfile.ZipFile (filename) as zip:
-    for entry in zip.namelist ():
+    invoices = {}
+    replayed = set ()
 
-        print (entry)
+    #
+    # States of a snapshot written for the same invoice contents are taken over as they are
+    #
+    trusted = snapshot.trusted () if snapshot is not None else {}
 
-        if (entry.endswith ('invoices.csv')):
-            with zip.open (entry, 'r') as file:
-                database.add (file, 'invoices')
-        elif (entry.endswith ('invoice_medication.csv')):
-            with zip.open (entry, 'r') as file:
-                database.add (file, 'invoice_medication')
-        elif (entry.endswith ('invoice_product.csv')):
-            with zip.open (entry, 'r') as file:
-                database.add (file, 'invoice_product')
-        elif (entry.endswith ('invoice_service.csv')):
-            with zip.open (entry, 'r') as file:
-                database.add (file, 'invoice_service')
-        elif (entry.endswith ('payments.csv')):
-            with zip.open (entry, 'r') as file:
-                database.add (file, 'payments')
-        elif (entry.endswith ('tax.csv')):
-            with zip.open (entry, 'r') as file:
-                database.add (file, 'tax')
-        elif (entry.endswith ('clients.csv')):
-            with zip.open (entry, 'r') as file:
-                database.add (file, 'clients')
+    complete = [invoice_id for invoice_id in database.range ('invoices')
+                if database.get ('invoices', invoice_id, 'status') == 'complete']
+    count = len (complete)
 
-#
-# Generate invoice handling instances
-#
-invoices = {}
+    #
+    # Invoices not touched by this run stay in the allocation log
+    #
+    if log is not None:
+        complete = [invoice_id for invoice_id in complete if not log.keep (invoice_id)]
 
-for invoice_id in database.range ('invoices'):
+    #
+    # Sum up the line items of all other invoices at once if NumPy is available. The
+    # vectorised pass covers all line items, so it pays off for larger shares only.
+    #
+    debts = None
+    summed = [invoice_id for invoice_id in complete if invoice_id not in trusted]
 
-    if database.get ('invoices', invoice_id, 'status') == 'complete':
+    if np is not None and 4 * len (summed) > count:
+        debts = Invoice.sumContents (database, summed)
 
-        #
-        # Generate complete invoice information
-        #
-        invoice = Invoice (database, invoice_id)
+    for invoice_id in complete:
 
-        if False:
-            print ("Invoice #" + str (invoice_id) + " (" + invoice._number + "): " + str (invoice._open))
+        if invoice_id in trusted:
+            invoices[invoice_id] = Invoice (database, invoice_id, state=trusted[invoice_id])
+            continue
 
         #
-        # Reduce invoice by payments already performed in previous months
+        # Generate complete invoice information. A matching log or snapshot state
+        # makes the replay of its payments unnecessary.
         #
-        for payment_id in database.range ('payments'):
-
-            #
-            # Use only payments for the processed invoice and skip cancelled payments at all
-            #
-            if not database.get ('payments', payment_id, 'deleted'):
-                payment_invoice_id = database.get ('payments', payment_id, 'invoice_id')
-                if payment_invoice_id and (payment_invoice_id == invoice_id):
-                    date = stringToDate (database.get ('payments', payment_id, 'date'))
-
-                    if (date.year < year) or (date.year == year and date.month < month):
-                        invoice.applyPayment (database, payment_id)
+        invoice = Invoice (database, invoice_id, debts.get (invoice_id, []) if debts is not None else None)
+        invoices[invoice_id] = invoice
 
-        if False:
-            print ("  --> " + str (invoice._open))
+        if log is not None:
+            restored = log.restore (database, invoice)
+        else:
+            restored = snapshot is not None and snapshot.restore (invoice)
 
-        invoices[invoice_id] = invoice
+        if not restored:
+            replayed.add (invoice_id)
 
+            if log is not None:
+                log.track (invoice)
 
-#
-# Process payment list for the given month to generate DATEV file
-#
-datev = []
+    #
+    # Invoices taken from a snapshot of an earlier month still lack the payments since
+    #
+    since = first_month
 
-for payment_id in database.range ('payments'):
+    if snapshot is not None and snapshot.month () is not None:
+        since = snapshot.month ()
 
-    date = stringToDate (database.get ('payments', payment_id, 'date'))
+    if not replayed and since == first_month:
+        return invoices
 
     #
-    # Given month only
+    # Reduce the invoices by the payments already performed before the month
     #
-    if date.year == year and date.month == month:
+    for payment_id in database.lookup ('payments', (), ()):
+        payment_month = database.get ('payments', payment_id, 'date_month')
+
+        if payment_month >= first_month:
+            break
 
         #
-        # Accountants tax application cannot process payments with 0€ amount
+        # Skip cancelled payments at all
         #
-        if roundEuro (float (database.get ('payments', payment_id, 'amount'))) != 0:
+        if not database.get ('payments', payment_id, 'deleted'):
+            invoice_id = database.get ('payments', payment_id, 'invoice_id')
 
-            #
-            # Skip cancelled payments
-            #
-            if not database.get ('payments', payment_id, 'deleted'):
+            if invoice_id in replayed or (payment_month >= since and invoice_id in invoices):
+                invoices[invoice_id].applyPayment (database, payment_id)
 
-                invoice_id = database.get ('payments', payment_id, 'invoice_id')
+    return invoices
 
-                #
-                # Case 1: Invoice based payment
-                #
-                if invoice_id:
-                    assert invoice_id in invoices
+#
+# Generate the DATEV entries of a month
+#
+# The invoices are reduced by the payments of the month, so they can be passed
+# on to the following month afterwards.
+#
+# @param database Database we are working with
+# @param invoices Invoices as returned by 'createInvoices ()' for the same month
+# @param year     Exported year
+# @param month    Exported month
+# @return List of DATEV entries
+#
+def createEntries (database, invoices, year, month):
+    return list (MonthExport (database, year, month, invoices).entries ())
 
-                    #
-                    # The invoice debt is reduced by the payment just made. The paid parts
-                    # are returned in this process and will be used to generate a single
-                    # DATEV entry for each part.
-                    #
-                    parts = invoices[invoice_id].applyPayment (database, payment_id)
+#
+# Export the DATEV rows of a month
+#
+# @param database Database we are working with
+# @param year     Exported year
+# @param month    Exported month
+# @param invoices Invoices as returned by 'createInvoices ()' for the same month.
+#                 If 'None', the invoice state is computed from the payment history.
+# @return List of DATEV rows (without header)
+#
+def exportMonth (database, year, month, invoices=None):
+    if invoices is None:
+        invoices = createInvoices (database, year, month)
 
-                    for part in parts:
-                        entry = DatevEntry (database, payment_id)
-                        entry.setupInvoiceEntry (database, invoice_id, part)
-                        datev.append (entry)
+    return [entry.toDatev () for entry in MonthExport (database, year, month, invoices).entries ()]
 
-                #
-                # Case 2: Non-invoice based payment
-                #
-                else:
-                    entry = DatevEntry (database, payment_id)
-                    entry.setupNonInvoiceEntry ()
-                    datev.append (entry)
+#
+# Generate crosscheck rows for the EC card and bank transfer payments of a month
+#
+# @param database Database we are working with
+# @param year     Exported year
+# @param month    Exported month
+# @return List of crosscheck rows (without header)
+#
+def crosscheckMonth (database, year, month):
+    return MonthExport (database, year, month).run ().crosscheck ()
 
-                #
-                # In case of EC card payments, setup additional counter entry. Exception exists, like
-                # 'Mahngebuehren' which have to be entered manually and separately without having an
-                # invoice.
-                #
-                if database.get ('payments', payment_id, 'method') == 'ec':
-                    entry = DatevEntry (database, payment_id)
-                    entry.setupECCounterEntry (database, payment_id, invoice_id)
-                    datev.append (entry)
+#
+# Compute the petty cash balance before a month
+#
+# @param database Database we are working with
+# @param year     Year of the month
+# @param month    Month the balance is computed for
+# @return Sum of all cash payments before that month in cents
+#
+def computePettyCash (database, year, month):
+    return Totals (database).pettyCash (monthKey (year, month))
 
+#
+# Compute turnover and petty cash change of a month
+#
+# @param database Database we are working with
+# @param year     Exported year
+# @param month    Exported month
+# @return (turnover, cash) tuple with the invoice based and the cash payments of the month in cents
+#
+def computeTotals (database, year, month):
+    totals = Totals (database)
+    return totals.turnover (monthKey (year, month)), totals.cash (monthKey (year, month))
 
 #
-# Extract result as DATEV file
+# Write rows into a file with DATEV CSV dialect
 #
-csv.register_dialect ('datev',
-                      delimiter=';',
-                      quoting=csv.QUOTE_ALL,
-                      quotechar='"')
+# @param filename Name of the output file
+# @param header   Header row
+# @param rows     Iterable of rows. Generated rows are written one by one as they arrive.
+# @return Number of rows written (without header)
+#
+def writeRows (filename, header, rows):
+    count = 0
 
-with open (output, 'w', newline='') as file:
-    writer = csv.writer (file, dialect='datev')
+    with open (filename, 'w', newline='') as file:
+        writer = csv.writer (file, dialect='datev')
 
-    writer.writerow (datev_columns)
+        writer.writerow (header)
 
-    for entry in datev:
-        writer.writerow (entry.toDatev ())
+        for row in rows:
+            writer.writerow (row)
+            count += 1
+
+    return count
 
-#
-# Generate crosscheck table if requested
-#
-if crosscheck is not None:
 
-    ec_payments = []
-    bill_payments = []
+#---------------------------------------------------------------------
+# MAIN
+#---------------------------------------------------------------------
 
-    for payment_id in database.range ('payments'):
+def main ():
 
-        #
-        # Use only payments for the processed invoice and skip cancelled payments at all
-        #
-        if not database.get ('payments', payment_id, 'deleted'):
-            amount = roundEuro (float (database.get ('payments', payment_id, 'amount')))
-            date = stringToDate (database.get ('payments', payment_id, 'date'))
-            method = database.get ('payments', payment_id, 'method')
+    #
+    # Parse command line arguments
+    #
+    parser = argparse.ArgumentParser ()
+
+    parser.add_argument ('file',               type=str, help='Name of backup ZIP file')
+    parser.add_argument ('-m', '--month',      type=int, help='Month (MM)')
+    parser.add_argument ('-y', '--year',       type=int, help='Year (YYYY)')
+    parser.add_argument ('-f', '--from',       type=str, dest='first',
+                         help='First month of a multi month export (YYYY-MM)')
+    parser.add_argument ('-t', '--to',         type=str, dest='last',
+                         help='Last month of a multi month export (YYYY-MM)')
+    parser.add_argument ('-o', '--output',     type=str,
+                         help='Name of the output file. May contain {year} and {month} fields, '
+                              'which are mandatory for multi month exports.')
+    parser.add_argument ('-c', '--crosscheck', type=str,
+                         help='Name of the crosscheck file. May contain {year} and {month} fields, '
+                              'which are mandatory for multi month exports.')
+    parser.add_argument ('-s', '--snapshot',   type=str,
+                         help='Directory for invoice allocation snapshots between runs. Holds the '
+                              'snapshots of a single practice, which are reused by its later backups.')
+    parser.add_argument ('--since-backup',     type=str, dest='since',
+                         help='Previous backup of the same practice. Only the DATEV rows of payments '
+                              'booked or changed since are exported.')
+    parser.add_argument ('-l', '--log',        type=str,
+                         help='Append-only log of the payments allocated to the invoices, e.g. next to the output')
+    parser.add_argument ('-j', '--jobs',       type=int, default=os.cpu_count (),
+                         help='Number of processes reading the backup tables concurrently')
+    parser.add_argument ('-k', '--cashbook',   type=str,
+                         help='Name of the cash book file covering all exported months')
+    parser.add_argument ('--daily',            action='store_true',
+                         help='Keep the cash book per day instead of per month')
+
+    args = parser.parse_args ()
+
+    filename   = args.file
+    output     = args.output
+    crosscheck = args.crosscheck
+    cashbook   = args.cashbook
+
+    assert len (filename) > 0
+    assert output is not None or cashbook is not None
 
-            if date.year == year and date.month == month:
+    #
+    # The exported months are either given as a single month/year pair or as a
+    # 'YYYY-MM' based range processed in a single run
+    #
+    if args.first is not None:
+        first_month = stringToMonth (args.first)
+        last_month  = stringToMonth (args.last) if args.last is not None else first_month
+    else:
+        assert args.month >= 1 and args.month <= 12
+        assert args.year >= 2000
 
-                amount = locale.format ('%.2f', abs (amount))
-                date = date.strftime ('%d-%m-%Y')
-                bill_number = None
-                name = None
+        first_month = monthKey (args.year, args.month)
+        last_month  = first_month
 
+    if first_month > last_month:
+        parser.error ('first month {} is after last month {}'.format (args.first, args.last))
 
-                invoice_id = database.get ('payments', payment_id, 'invoice_id')
-                if invoice_id:
-                    bill_number = database.get ('invoices', invoice_id, 'number')
-                    client_id = database.get ('invoices', invoice_id, 'client_id')
+    #
+    # Each month of a multi month export needs its own files
+    #
+    if first_month != last_month:
+        for option, name in [('--output', output), ('--crosscheck', crosscheck)]:
+            if name is not None and ('{year' not in name or '{month' not in name):
+                parser.error ('{} must contain {{year}} and {{month}} for multi month exports'.format (option))
 
-                    if client_id:
-                        name = database.get ('clients', client_id, 'lastname')
+    #
+    # Invoices kept in the allocation log are not created at all, so there is no
+    # complete invoice state to be written into a snapshot
+    #
+    if args.snapshot is not None and args.log is not None:
+        parser.error ('--snapshot and --log cannot be combined')
+
+    #
+    # Read the registered CSV files from backup ZIP file into database
+    #
+    database = loadBackup (filename, args.jobs)
 
-                if method == 'ec':
-                    ec_payments.append ([date, amount, 'EC Karte', bill_number, name])
-                elif method == 'bill':
-                    bill_payments.append ([date, amount, 'Überweisung', bill_number, name])
+    #
+    # Cash book report for the complete range of months, if requested. Without
+    # output file, the cash book is the only result.
+    #
+    if cashbook is not None:
+        writeRows (cashbook, CashBook.columns, CashBook (database, args.daily).rows (first_month, last_month))
 
-    ec_payments.sort (key=lambda row: row[0])
-    bill_payments.sort (key=lambda row: row[0])
+    if output is None:
+        return
 
-    with open (crosscheck, 'w', newline='') as file:
-        writer = csv.writer (file, dialect='datev')
+    #
+    # Delta export against a previous backup, if requested. The invoice states are
+    # still computed from the complete current backup.
+    #
+    payments = None
 
-        writer.writerow (['Datum', 'Betrag', 'Zahlweise', 'Rechnungsnummer', 'Name'])
+    if args.since is not None:
+        delta = BackupDelta (loadBackup (args.since, args.jobs), database)
+        delta.check (first_month, last_month)
+        payments = delta.payments ()
 
-        for payment in ec_payments:
-            writer.writerow (payment)
+    #
+    # Invoice allocation snapshot at the beginning of the first exported month, if requested
+    #
+    snapshot = None
 
-        for payment in bill_payments:
-            writer.writerow (payment)
+    if args.snapshot is not None:
+        snapshot = Snapshot (args.snapshot, filename)
+        snapshot.load (database, first_month)
 
+    #
+    # Allocation log of the previous runs, if requested. Invoices whose logged
+    # payments are unchanged continue from the log and allocate new payments only.
+    #
+    log = None
 
+    if args.log is not None:
+        log = AllocationLog (args.log)
+        log.prepare (database, first_month, last_month)
 
-#
-# Generate some additional information
-#
-petty_cash = 0.0
-turnover   = 0.0
+    #
+    # Invoice state and cash balance at the beginning of the first exported month
+    #
+    invoices = createInvoices (database, *keyToMonth (first_month), snapshot=snapshot, log=log)
+    totals = Totals (database)
+
+    #
+    # Process the exported months in chronological order. The invoice debts are
+    # reduced by the payments of each month, so every following month continues
+    # with the invoice state of its predecessor. Each month is processed in a
+    # single pass over its payments.
+    #
+    for export_month in range (first_month, last_month + 1):
+
+        year, month = keyToMonth (export_month)
+
+        #
+        # The log keeps the invoice states at the beginning of the last exported
+        # month, so that month can be exported again with later backups
+        #
+        if log is not None and export_month == last_month:
+            log.record (database, invoices, export_month)
 
-for payment_id in database.range ('payments'):
+        export = MonthExport (database, year, month, invoices, payments)
 
-    if not database.get ('payments', payment_id, 'deleted'):
-        amount = roundEuro (float (database.get ('payments', payment_id, 'amount')))
-        date = stringToDate (database.get ('payments', payment_id, 'date'))
+        #
+        # Extract result as DATEV file
+        #
+        writeRows (output.format (year=year, month=month), datev_columns,
+                   (entry.toDatev () for entry in export.entries ()))
 
+        #
+        # Generate crosscheck table if requested
+        #
+        if crosscheck is not None:
+            writeRows (crosscheck.format (year=year, month=month),
+                       ['Datum', 'Betrag', 'Zahlweise', 'Rechnungsnummer', 'Name'],
+                       export.crosscheck ())
 
         #
-        # Petty cash
+        # Keep the invoice allocation state for continuing with the next month
         #
-        if database.get ('payments', payment_id, 'method') == 'cash':
-            if (date.year < year) or (date.year == year and date.month <= month):
-                petty_cash += amount
+        if snapshot is not None:
+            snapshot.save (database, export_month + 1, invoices)
 
         #
-        # Turnover
+        # Generate some additional information
         #
-        if database.get ('payments', payment_id, 'invoice_id'):
-            if date.year == year and date.month == month:
-                turnover += amount
+        if first_month != last_month:
+            print ('Monat   : {:02d}/{}'.format (month, year))
+
+        print ('Umsatz  : {:.2f} Euro'.format (export.turnover / 100.0))
+        print ('Barkasse: {:.2f} Euro'.format (totals.pettyCash (export_month + 1) / 100.0))
+
+    if log is not None:
+        log.save ()
+
 
-print ('Umsatz  : {:.2f} Euro'.format (turnover))
-print ('Barkasse: {:.2f} Euro'.format (petty_cash))
+if __name__ == '__main__':
+    main ()
@@ -1,9 +1,10 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 #-------------------------------------------------------------------------------------------------
-# datevexport.py - Export monthly DATEV table from InBehandlung backup file database
+# datevexport_pandas.py - Export monthly DATEV table from InBehandlung backup file database
+#                         using column oriented pandas operations
 #
-# Syntax: datevexport.py <backup zip file> <month (MM)> <year (YYYY)> <output file>
+# Syntax: datevexport_pandas.py <backup zip file> -m <month (MM)> -y <year (YYYY)> -o <output file>
 #
 # License: MIT License
 #-------------------------------------------------------------------------------------------------
@@ -28,207 +29,58 @@
 #-------------------------------------------------------------------------------------------------
 
 import argparse
-import copy
+import collections
 import csv
-import datetime
-import io
-import locale
 import warnings
 import zipfile
 
 import numpy as np
 import pandas as pd
 
+from datevexport import Accounts, datev_columns, datev_column_mapping, database_tables, monthKey
+
 #---------------------------------------------------------------------
 # Configuration
 #---------------------------------------------------------------------
 
 #
-# Account number used for DATEV transfers
+# Invoice line item domains as (domain, table, 'applied' condition) in the
+# order the invoice parts are collected
 #
-class Accounts:
-
-    #
-    # Target accounts
-    #
-    Null     = 0000
-    Main     = 1001
-    Bank     = 1360
-    EC       = 1361
-    Transfer = 1362
-
-    #
-    # Source accounts (the accountant calculates with)
-    #
-    Services_19            = 8004
-    Services_7             = 8004
-    Medications_Applied_19 = 8014
-    Medications_Applied_7  = 8011
-    Medications_19         = 8024
-    Medications_7          = 8021
-    Products_19            = 8034
-    Products_7             = 8031
+line_item_domains = [
+    ('products',           'invoice_product',    None),
+    ('medication',         'invoice_medication', '0'),
+    ('medication_applied', 'invoice_medication', '1'),
+    ('services',           'invoice_service',    None)
+]
 
+#
+# Tax accounts of the line item domains as (19% account, 7% account) pairs
+#
+line_item_accounts = {
+    'products'          : (Accounts.Products_19,            Accounts.Products_7),
+    'medication'        : (Accounts.Medications_19,         Accounts.Medications_7),
+    'medication_applied': (Accounts.Medications_Applied_19, Accounts.Medications_Applied_7),
+    'services'          : (Accounts.Services_19,            Accounts.Services_7)
+}
 
 #
-# DATEV table column headers
+# DATEV item kinds of the line item domains
 #
-datev_columns = [
-    'Umsatz (ohne Soll/Haben-Kz)',    # 1
-    'Soll/Haben-Kennzeichen',         # 2
-    'WKZ Umsatz',                     # 3
-    'Kurs',                           # 4
-    'Basis-Umsatz',                   # 5
-    'WKZ Basis-Umsatz',               # 6
-    'Konto',                          # 7
-    'Gegenkonto (ohne BU-Schlüssel)', # 8
-    'BU-Schlüssel',                   # 9
-    'Belegdatum',                     # 10
-    'Belegfeld 1',                    # 11
-    'Belegfeld 2',                    # 12
-    'Skonto',                         # 13
-    'Buchungstext',                   # 14
-    'Postensperre',                   # 15
-    'Diverse Adressnummer',           # 16
-    'Geschäftspartnerbank',           # 17
-    'Sachverhalt',                    # 18
-    'Zinssperre',                     # 19
-    'Beleglink',                      # 20
-    'Beleginfo - Art 1',              # 21
-    'Beleginfo - Inhalt 1',           # 22
-    'Beleginfo - Art 2',              # 23
-    'Beleginfo - Inhalt 2',           # 24
-    'Beleginfo - Art 3',              # 25
-    'Beleginfo - Inhalt 3',           # 26
-    'Beleginfo - Art 4',              # 27
-    'Beleginfo - Inhalt 4',           # 28
-    'Beleginfo - Art 5',              # 29
-    'Beleginfo - Inhalt 5',           # 30
-    'Beleginfo - Art 6',              # 31
-    'Beleginfo - Inhalt 6',           # 32
-    'Beleginfo - Art 7',              # 33
-    'Beleginfo - Inhalt 7',           # 34
-    'Beleginfo - Art 8',              # 35
-    'Beleginfo - Inhalt 8',           # 36
-    'KOST1 - Kostenstelle',           # 37
-    'KOST2 - Kostenstelle',           # 38
-    'Kost-Menge',                     # 39
-    'EU-Land u. UStID',               # 40
-    'EU-Steuersatz',                  # 41
-    'Abw. Versteuerungsart',          # 42
-    'Sachverhalt L+L',                # 43
-    'Funktionsergänzung L+L',         # 44
-    'BU 49 Hauptfunktionstyp',        # 45
-    'BU 49 Hauptfunktionsnummer',     # 46
-    'BU 49 Funktionsergänzung',       # 47
-    'Zusatzinformation - Art 1',      # 48
-    'Zusatzinformation- Inhalt 1',    # 49
-    'Zusatzinformation - Art 2',      # 50
-    'Zusatzinformation- Inhalt 2',    # 51
-    'Zusatzinformation - Art 3',      # 52
-    'Zusatzinformation- Inhalt 3',    # 53
-    'Zusatzinformation - Art 4',      # 54
-    'Zusatzinformation- Inhalt 4',    # 55
-    'Zusatzinformation - Art 5',      # 56
-    'Zusatzinformation- Inhalt 5',    # 57
-    'Zusatzinformation - Art 6',      # 58
-    'Zusatzinformation- Inhalt 6',    # 59
-    'Zusatzinformation - Art 7',      # 60
-    'Zusatzinformation- Inhalt 7',    # 61
-    'Zusatzinformation - Art 8',      # 62
-    'Zusatzinformation- Inhalt 8',    # 63
-    'Zusatzinformation - Art 9',      # 64
-    'Zusatzinformation- Inhalt 9',    # 65
-    'Zusatzinformation - Art 10',     # 66
-    'Zusatzinformation- Inhalt 10',   # 67
-    'Zusatzinformation - Art 11',     # 68
-    'Zusatzinformation- Inhalt 11',   # 69
-    'Zusatzinformation - Art 12',     # 70
-    'Zusatzinformation- Inhalt 12',   # 71
-    'Zusatzinformation - Art 13',     # 72
-    'Zusatzinformation- Inhalt 13',   # 73
-    'Zusatzinformation - Art 14',     # 74
-    'Zusatzinformation- Inhalt 14',   # 75
-    'Zusatzinformation - Art 15',     # 76
-    'Zusatzinformation- Inhalt 15',   # 77
-    'Zusatzinformation - Art 16',     # 78
-    'Zusatzinformation- Inhalt 16',   # 79
-    'Zusatzinformation - Art 17',     # 80
-    'Zusatzinformation- Inhalt 17',   # 81
-    'Zusatzinformation - Art 18',     # 82
-    'Zusatzinformation- Inhalt 18',   # 83
-    'Zusatzinformation - Art 19',     # 84
-    'Zusatzinformation- Inhalt 19',   # 85
-    'Zusatzinformation - Art 20',     # 86
-    'Zusatzinformation- Inhalt 20',   # 87
-    'Stück',                          # 88
-    'Gewicht',                        # 89
-    'Zahlweise',                      # 90
-    'Forderungsart',                  # 91
-    'Veranlagungsjahr',               # 92
-    'Zugeordnete Falligkeit',         # 93
-    'Skontotyp',                      # 94
-    'Auftragsnummer',                 # 95
-    'Buchungstyp',                    # 96
-    'USt-Schlüssel (Anzahlungen)',    # 97
-    'EU-Land (Anzahlungen)',          # 98
-    'Sachverhalt L+L (Anzahlungen)',  # 99
-    'EU-Steuersatz (Anzahlungen)',    # 100
-    'Erlöskonto (Anzahlungen)',       # 101
-    'Herkunft-Kz',                    # 102
-    'Buchungs GUID',                  # 103
-    'KOST-Datum',                     # 104
-    'SEPA-Mandatsreferenz',           # 105
-    'Skontosperre',                   # 106
-    'Gesellschaftername',             # 107
-    'Beteiligtennummer',              # 108
-    'Identifikationsnummer',          # 109
-    'Zeichnernummer',                 # 110
-    'Postensperre bis',               # 111
-    'Bezeichnung SoBil-Sachverhalt',  # 112
-    'Kennzeichen SoBil-Buchung',      # 113
-    'Festschreibung',                 # 114
-    'Leistungsdatum',                 # 115
-    'Datum Zuord. Steuerperiode'      # 116
-    ]
+line_item_kinds = {
+    'products'          : 'Produkte',
+    'medication'        : 'Medikamente (abgegeben)',
+    'medication_applied': 'Medikamente (angewendet)',
+    'services'          : 'Leistungen'
+}
 
 #
-# Readable ids for mapping a semantics to a DATEV column
+# DATEV payment kinds of the payment methods
 #
-datev_column_mapping = {
-    'umsatz'            : 1,
-    'soll_haben'        : 2,
-    'konto'             : 7,
-    'gegenkonto'        : 8,
-    'bu_schluessel'     : 9,
-    'belegdatum'        : 10,
-    'belegfeld_1'       : 11,
-    'belegfeld_2'       : 12,
-    'buchungstext'      : 14,
-    'sachverhalt'       : 18,
-    'beleginfo_art_1'   : 21,
-    'beleginfo_inhalt_1': 22,
-    'beleginfo_art_2'   : 23,
-    'beleginfo_inhalt_2': 24,
-    'beleginfo_art_3'   : 25,
-    'beleginfo_inhalt_3': 26,
-    'beleginfo_art_4'   : 27,
-    'beleginfo_inhalt_4': 28,
-    'beleginfo_art_5'   : 29,
-    'beleginfo_inhalt_5': 30,
-    'beleginfo_art_6'   : 31,
-    'beleginfo_inhalt_6': 32,
-    'beleginfo_art_7'   : 33,
-    'beleginfo_inhalt_7': 34,
-    'beleginfo_art_8'   : 35,
-    'beleginfo_inhalt_8': 36,
-    'eu_steuersatz'     : 41,
-    'stueck'            : 88,
-    'zahlweise'         : 90,
-    'auftragsnummer'    : 95,
-    'buchungstyp'       : 96,
-    'gesellschaftername': 107,
-    'leistungsdatum'    : 115
+payment_kinds = {
+    'ec'  : 'EC-Karte',
+    'cash': 'Bar',
+    'bill': 'Überweisung'
 }
 
 
@@ -237,232 +89,210 @@ datev_column_mapping = {
 #---------------------------------------------------------------------
 
 #
-# Round into full euro and cents
+# Round into full euro and cents (works on scalars and arrays)
 #
 def roundEuro (n):
-    return round (100.0 * n + 0.0001) / 100.0
+    return np.round (100.0 * n + 0.0001) / 100.0
 
 #
-# Convert CSV date string representation into Python date class
+# Format amounts with German decimal comma
 #
-def stringToDate (text):
-    print (text, type (text))
-    return datetime.datetime.strptime (text, '%Y-%m-%d %H:%M:%S')
-
+def formatAmount (values):
+    return values.abs ().map ('{:.2f}'.format).str.replace ('.', ',', regex=False)
 
-#---------------------------------------------------------------------
-# CLASS Database
 #
-# This class keeps the set of all file databases
-#---------------------------------------------------------------------
+# Sum values per group in row order
+#
+# The values are added one by one like a plain Python loop would do, so the
+# floating point results are identical to the dictionary based engine. Each
+# step adds the k-th value of every group at once.
+#
+# @param groups Group number of each value
+# @param values Values to be summed
+# @param count  Number of groups
+# @return Array with the sum of each group
+#
+def sequentialSum (groups, values, count):
+    totals = np.zeros (count)
 
-class Database:
+    if len (groups) > 0:
+        position = pd.Series (groups).groupby (groups).cumcount ().to_numpy ()
 
-    def __init__ (self):
-        self._data = {}
+        for k in range (position.max () + 1):
+            mask = position == k
+            totals[groups[mask]] += values[mask]
 
-    #
-    # Return single cell content of a file database
-    #
-    # @param database Name of the file database to access
-    # @param id       Id of the entry
-    # @param key      Key of the column to access
-    #
-    def get (self, database, id, key):
-        assert database in self._data
-        return self._data[database].loc[id][key]
+    return totals
 
-    #
-    # Check if the database supports the given key
-    #
-    # @param key Key to check
-    #
-    def has (self, database, key):
-        assert database in self._data
 
-        found = False
+#---------------------------------------------------------------------
+# Database
+#---------------------------------------------------------------------
+
+#
+# Read a single registered table from the backup ZIP file
+#
+# The registered columns are converted into their types, 'NULL' cells become
+# empty strings, NaN or NaT. Money columns are kept as euro floats, this engine
+# rounds them itself. Rows are sorted by their id like the dictionary based
+# engine iterates them.
+#
+# @param archive Opened backup ZIP file
+# @param entry   Name of the CSV file in the archive
+# @param name    Name of the table
+# @return Data frame with the table content
+#
+def readTable (archive, entry, name):
+    columns = database_tables[name]
 
-        try:
-            found = not np.isnan (self._data[database].loc[id][key])
-        except KeyError:
-            pass
+    with archive.open (entry, 'r') as file:
+        table = pd.read_csv (file, delimiter=',', quotechar='\"', encoding='utf-8', dtype=str,
+                             keep_default_na=False, usecols=lambda column: column in columns)
 
-        return found
+    for column in table.columns:
+        if columns[column] == 'float' or columns[column] == 'cents':
+            table[column] = table[column].replace ('NULL', 'nan').astype (float)
+        elif columns[column] == 'date':
+            table[column] = pd.to_datetime (table[column].replace ('NULL', None), format='%Y-%m-%d %H:%M:%S')
+        else:
+            table[column] = table[column].replace ('NULL', '').astype (object)
 
+    return table.sort_values ('id', kind='stable').reset_index (drop=True)
 
-        return self._data[database].has (key)
+#
+# Read all registered tables from backup ZIP file
+#
+# @param filename Name of the backup ZIP file
+# @return Dictionary of (table name, data frame) items
+#
+def loadBackup (filename):
+    tables = {}
 
-    #
-    # Return range of ids present in the file database
-    #
-    def range (self, database):
-        assert database in self._data
-        return list (self._data[database].index.values)
+    with zipfile.ZipFile (filename) as archive:
+        for entry in archive.namelist ():
+            for name in database_tables:
+                if entry.endswith (name + '.csv'):
+                    tables[name] = readTable (archive, entry, name)
+                    break
 
-    #
-    # Read new file database and add it to the content
-    #
-    def add (self, file, name):
-        print ('Read: {}'.format (name))
-        df  = pd.read_csv (file, delimiter=',', quotechar='\"', encoding='utf-8')
-        df.set_index ('id', inplace=True)
-        self._data[name] = df
-        #print (df)
+    return tables
 
 
 #---------------------------------------------------------------------
-# CLASS Invoice
+# Invoices
 #---------------------------------------------------------------------
 
 #
-# This class keeps record about a single invoice, split into different
-# tax related parts
+# Compute the debt buckets of all complete invoices
 #
-class Invoice:
+# Each line item contributes roundEuro (amount * factor * count * price) to the
+# bucket of its (invoice, domain, tax) combination. Line items of draft invoices
+# or of no invoice at all are skipped, so their tax rates are never mapped to
+# accounts. The buckets of an invoice are ordered by domain and first appearance
+# of the tax and then sorted by tax rate, because lower tax items are paid first.
+#
+# @param tables Dictionary of all tables
+# @return Data frame with invoice_id, domain, tax_id, tax, account and sum columns
+#         in payment order
+#
+def computeDebt (tables):
+    frames = []
 
-    #
-    # Constructor
-    #
-    # @param id Unique invoice id
-    #
-    def __init__ (self, database, id):
-
-        #
-        # Gather some information about the invoice itself
-        #
-        self._id = id
-        self._number = database.get ('invoices', id, 'number')
-
-        self._total = float (database.get ('invoices', id, 'total'))
-        self._open = self._total
-
-        #
-        # Collect parts of the invoice which must sum up to the total and
-        # will be used to split the total into the different tax parts
-        #
-        if False:
-            print ('Invoice: ' + str (id) + ' (' + self._number + ')')
-
-        self._debt = []
-        self._debt += self.sumContent (database, 'products',           'invoice_product',    id, {})
-        self._debt += self.sumContent (database, 'medication',         'invoice_medication', id, {'applied': '0'})
-        self._debt += self.sumContent (database, 'medication_applied', 'invoice_medication', id, {'applied': '1'})
-        self._debt += self.sumContent (database, 'services',           'invoice_service',    id, {})
-
-        #
-        # IMPORTANT OPTIMIZATION: Lower tax items are processed FIRST because if
-        # a customer does only pay a part of an invoice, we will have to pay
-        # less taxes at least.
-        #
-        self._debt.sort (key=lambda entry: float (database.get ('tax', entry['tax'], 'tax')))
-
-        total = 0.0
-        for item in self._debt:
-            total += item['sum']
-
-        if False:
-            print ('  --> total (invoice): ' + str (self._total) + ', sum (parts): ' + str (total))
-
-        if roundEuro (self._total) != roundEuro (total):
-            print ('ERROR: Parts of invoice ' + str (id) + " do not sum up. Total is " +
-                   str (roundEuro (self._total)) + ", sum is " +
-                   str (total) + ".")
+    invoices = tables['invoices']
+    complete = invoices.loc[invoices['status'] == 'complete', 'id']
 
-    #
-    # Sum content of a database file belonging to a given invoice id
-    #
-    # @param database    Database we are working with
-    # @param domain      Item domain (product, service, medication, ...)
-    # @param file        Database file containing the detailed items
-    # @param invoice_id  Id of the invoice processed
-    # @param conditions  Additional conditions for the invoice data set to be
-    #                    valid for this case
-    # @return List of invoice parts consisting of (domain, tax, account, sum) dictionaries
-    #
-    @staticmethod
-    def sumContent (database, domain, file, invoice_id, conditions):
+    for domain, name, applied in line_item_domains:
+        items = tables[name]
+        items = items[items['invoice_id'].isin (complete)]
+
+        if applied is not None:
+            items = items[items['applied'] == applied]
+
+        value = pd.Series (1.0, index=items.index)
 
-        #
-        # Total computed for each tax case
-        #
-        total = {}
+        for key in ['amount', 'factor', 'count']:
+            if key in items.columns:
+                value = value * items[key]
 
-        #
-        # Iterate over invoice detail entries and process matching items
-        #
-        for id in database.range (file):
-            if database.get (file, id, 'invoice_id') == invoice_id:
+        frames.append (pd.DataFrame ({'invoice_id': items['invoice_id'],
+                                      'domain'    : domain,
+                                      'tax_id'    : items['tax_id'],
+                                      'value'     : roundEuro (value * items['price'])}))
 
-                #
-                # If additional conditions have been specified, these have
-                # to match the dataset, too
-                #
-                matches = True
+    items = pd.concat (frames, ignore_index=True)
 
-                for key in conditions:
-                    if database.get (file, id, key) != conditions[key]:
-                        matches = False
+    keys = ['invoice_id', 'domain', 'tax_id']
+    groups = items.groupby (keys, sort=False).ngroup ().to_numpy ()
 
-                if matches:
-                    amount = 1.0
-                    if database.has (file, 'amount'):
-                        amount = float (database.get (file, id, 'amount'))
+    debt = items.drop_duplicates (keys)[keys].reset_index (drop=True)
+    debt['sum'] = sequentialSum (groups, items['value'].to_numpy (), len (debt))
 
-                    factor = 1.0
-                    if database.has (file, 'factor'):
-                        factor = float (database.get (file, id, 'factor'))
+    #
+    # Map tax ids to tax rates and the (domain, rate) combinations to accounts
+    #
+    taxes = tables['tax'].set_index ('id')['tax']
+    debt['tax'] = debt['tax_id'].map (taxes)
 
-                    count = 1.0
-                    if database.has (file, 'count'):
-                        count = float (database.get (file, id, 'count'))
+    rates = debt['tax'].astype (float)
+    assert rates.isin ([19.0, 7.0, 0.0]).all ()
 
-                    tax_id = database.get (file, id, 'tax_id')
+    debt['account'] = [line_item_accounts[domain][0 if rate == 19.0 else 1]
+                       for domain, rate in zip (debt['domain'], rates)]
 
-                    price = float (database.get (file, id, 'price'))
+    #
+    # IMPORTANT OPTIMIZATION: Lower tax items are processed FIRST because if
+    # a customer does only pay a part of an invoice, we will have to pay
+    # less taxes at least.
+    #
+    return debt.iloc[np.argsort (rates.to_numpy (), kind='stable')].reset_index (drop=True)
 
-                    if tax_id not in total:
-                        total[tax_id] = 0.0
+#
+# Check that the parts of each complete invoice sum up to the invoice total
+#
+# @param invoices Data frame of the complete invoices
+# @param debt     Debt buckets as returned by 'computeDebt ()'
+#
+def checkTotals (invoices, debt):
+    debt = debt[debt['invoice_id'].isin (invoices['id'])]
 
-                    total[tax_id] += roundEuro (amount * factor * count * price)
+    position = pd.Index (invoices['id'])
+    totals = sequentialSum (position.get_indexer (debt['invoice_id']), debt['sum'].to_numpy (), len (invoices))
 
-                    if False:
-                        print ('  ' + file + ', ' + str (amount) +
-                               ' * ' + str (factor) +
-                               ' * ' + str (count) +
-                               ' * ' + str (price) +
-                               ' = ' + str (roundEuro (amount * factor * count * price)) +
-                               ' (' + str (amount * factor * count * price) + ')')
+    for id, total, parts in zip (invoices['id'], invoices['total'], totals):
+        if roundEuro (total) != roundEuro (parts):
+            print ('ERROR: Parts of invoice ' + str (id) + " to not sum up. Total is " +
+                   str (float (roundEuro (total))) + ", sum is " +
+                   str (float (parts)) + ".")
 
-        #
-        # Generate result entries containing a domain/tax depending set of entries
-        #
-        result = []
 
-        for tax_id in total.keys ():
-            result.append ({'domain' : domain,
-                            'tax'    : tax_id,
-                            'account': Invoice.computeTaxAccount (database, domain, tax_id),
-                            'sum'    : total[tax_id]})
+#
+# Allocation state of a single invoice
+#
+class Invoice:
 
-        return result
+    #
+    # Constructor
+    #
+    # @param number Invoice number
+    # @param total  Invoice total
+    # @param debt   List of [domain, tax_id, account, sum] debt buckets in payment order
+    #
+    def __init__ (self, number, total, debt):
+        self._number = number
+        self._open = total
+        self._debt = collections.deque (debt)
 
     #
-    # Apply payment to invoice and reduce the appropriate debt items
+    # Apply payment to invoice and reduce the appropriate debt buckets
     #
-    # @param database   Database we are working with
     # @param payment_id Id of the payment to process
-    # @return List of the partial payments as (domain, tax, sum) dictionary
+    # @param amount     Rounded payment amount
+    # @return List of the partial payments as (domain, tax_id, account, sum) tuples
     #
-    def applyPayment (self, database, payment_id):
-
+    def applyPayment (self, payment_id, amount):
         parts = []
 
-        #
-        # Subtract payment amount from invoice sum. Because the sum is split
-        # up in (a) domains (services, products, medication, ) and (b) in
-        # tax rates, the different items have to be reduced one by one.
-        #
-        sum = roundEuro (float (database.get ('payments', payment_id, 'amount')))
+        sum = amount
         self._open = roundEuro (self._open - sum)
 
         while sum > 0.0 and len (self._debt) > 0:
@@ -471,22 +301,18 @@ class Invoice:
             #
             # Case 1: Partial payment of an entry
             #
-            if sum < entry['sum']:
-                entry['sum'] = roundEuro (entry['sum'] - sum)
-
-                part = copy.deepcopy (entry)
-                part['sum'] = sum
-                parts.append (part)
-
+            if sum < entry[3]:
+                entry[3] = roundEuro (entry[3] - sum)
+                parts.append ((entry[0], entry[1], entry[2], sum))
                 sum = 0.0
 
             #
             # Case 2: Entry fully paid
             #
             else:
-                sum = roundEuro (sum - entry['sum'])
-                parts.append (copy.deepcopy (entry))
-                self._debt.pop (0)
+                sum = roundEuro (sum - entry[3])
+                parts.append (tuple (entry))
+                self._debt.popleft ()
 
         if self._open < 0.0:
             warnings.warn ('Überzahlung in Rechnung {rechnung}, Zahlungsnummer {zahlung}. Theoretisches Guthaben von {betrag}.'
@@ -494,531 +320,319 @@ class Invoice:
 
         return parts
 
-    #
-    # Return tax account number matching the invoice part configuration
-    #
-    # @param database Database we are working with
-    # @param domain   Domain (products, services, medications, ...)
-    # @param tax_id   Internal ID of the tax used
-    # @return Account number matching the configuration
-    #
-    @staticmethod
-    def computeTaxAccount (database, domain, tax_id):
-
-        account = 0
-        tax = float (database.get ('tax', tax_id, 'tax'))
-
-        #
-        # Hard coced assertion necessary here to map the tax ids to account numbers
-        #
-        assert tax == 19.0 or tax == 7.0 or tax == 0.0
-
-        if domain == 'products':
-            account = Accounts.Products_19 if tax == 19.0 else Accounts.Products_7
-        elif domain == 'medication':
-            account = Accounts.Medications_19 if tax == 19.0 else Accounts.Medications_7
-        elif domain == 'medication_applied':
-            account = Accounts.Medications_Applied_19 if tax == 19.0 else Accounts.Medications_Applied_7
-        elif domain == 'services':
-            account = Accounts.Services_19 if tax == 19.0 else Accounts.Services_7
-        else:
-            raise "Unknown database domain '{}'".format (domain)
-
-        return account
-
-
 
 #---------------------------------------------------------------------
-# CLASS DatevEntry
+# DATEV entries
 #---------------------------------------------------------------------
 
 #
-# Class representing a single DATEV file entry
+# Build frame of DATEV entries from a frame of payments
 #
-# Valid fields are:
+# @param payments Payments the entries are derived from
+# @param fields   Entry fields overriding the defaults derived from the payment
+# @return Data frame with one column per entry field
 #
-# - invoice_id       - Id of the invoice
-# - invoice_date     - Date of the invoice
-# - payment_id       - Id of the payment itself
-# - payment_date     - Date of payment
-# - payment_kind     - Way of payment (cash, card, ...)
-# - payment_type     - Type of payment (transfer, ...)
-# - item_kind        - Kind of item applied/sold
-# - item_date        - Date the item was applied/sold
-# - item_description - Description of the item
-# - item_tax         - Tax of the item
-# - customer_id      - Id of the customer
-# - amount           - Amount of money
-# - remarks          - Payment remarks
-# - responsible      - Name of the responsible person
-# - account_from     - Account where the money came from
-# - account_to       - Account where the money goes to
-class DatevEntry:
+def createEntries (payments, **fields):
+    entries = pd.DataFrame ({
+        'order'           : payments['order'],
+        'sub'             : 0,
+        'invoice_id'      : '',
+        'invoice_date'    : '',
+        'payment_id'      : payments['id'],
+        'payment_date'    : payments['date'],
+        'payment_kind'    : payments['method'],
+        'item_kind'       : payments['paymenttype'],
+        'item_date'       : payments['date'],
+        'item_description': payments['notes'],
+        'item_tax'        : '',
+        'customer_id'     : '',
+        'amount'          : payments['amount'],
+        'remarks'         : '',
+        'responsible'     : payments['username'],
+        'account_from'    : Accounts.Null,
+        'account_to'      : Accounts.Null,
+        'payment_type'    : ''
+    }, index=payments.index)
 
-    #
-    # Constructor (all kinds of payments)
-    #
-    # @param database   Database we are working with
-    # @param payment_id Id of the payment to be processed
-    #
-    def __init__ (self, database, payment_id):
-
-        #
-        # The payment type is not known yet. Setup common fields only.
-        #
-        self._id               = payment_id
-        self._invoice_id       = ''
-        self._invoice_date     = ''
-        self._payment_id       = payment_id
-        self._payment_date     = stringToDate (self.get (database, 'date'))
-        self._payment_kind     = self.get (database, 'method')
-        self._item_kind        = self.get (database, 'paymenttype')
-        self._item_date        = self._payment_date
-        self._item_description = self.get (database, 'notes')
-        self._item_tax         = ''
-        self._customer_id      = ''
-        self._amount           = roundEuro (float (self.get (database, 'amount')))
-        self._remarks          = ''
-        self._responsible      = self.get (database, 'username')
-        self._account_from     = Accounts.Null
-        self._account_to       = Accounts.Null
-        self._payment_type     = ''
+    for key, value in fields.items ():
+        entries[key] = value
 
-    #
-    # Setup invoice based payment
-    #
-    # @param invoice_id    Id of the invoice the payment belongs to
-    # @param configuration Payment configuration as (domain, tax, account, sum) dictionary
-    #
-    def setupInvoiceEntry (self, database, invoice_id, configuration):
-        self._invoice_id = database.get ('invoices', invoice_id, 'number')
-        self._invoice_date = database.get ('invoices', invoice_id, 'date')
-        self._customer_id = database.get ('invoices', invoice_id, 'client_id')
-
-        self._item_tax = database.get ('tax', configuration['tax'], 'tax')
-
-        if configuration['domain'] == 'services':
-            self._item_kind = 'Leistungen'
-        elif configuration['domain'] == 'products':
-            self._item_kind = 'Produkte'
-        elif configuration['domain'] == 'medication':
-            self._item_kind = 'Medikamente (abgegeben)'
-        elif configuration['domain'] == 'medication_applied':
-            self._item_kind = 'Medikamente (angewendet)'
-        else:
-            self._item_kind = configuration['domain']
-
-        self._item_description = 'Rechnung {}'.format (self._invoice_id)
-        self._amount = configuration['sum']
-        self._payment_type = "Umsatz"
-        self._account_from = configuration['account']
-
-        #
-        # Payments via bank transfer are directly assigned to the bank account.
-        # Everything else, including EC card payments,  goes into the main account.
-        #
-        if self._payment_kind == 'bill':
-            self._account_to = Accounts.Transfer
-        else:
-            self._account_to = Accounts.Main
-
-    #
-    # Setup non invoice payment
-    #
-    def setupNonInvoiceEntry (self):
-        if self._item_kind.lower ().startswith ('geld auf bank'):
-            self._account_from     = Accounts.Bank
-            self._account_to       = Accounts.Main
-            self._payment_type     = 'Umbuchung'
-            self._item_kind        = 'Einzahlung'
-            self._item_description = 'Geld auf Bank'
-        else:
-            self._account_from = Accounts.Null
-            self._account_to   = Accounts.Main
-            self._payment_type = 'Barentnahme'
-            self._remarks      = self._item_kind
-            self._item_kind    = 'Barausgabe'
-
-
-    #
-    # Setup counter entry for moving another payment via ec card onto a
-    # special account for accounting purposes
-    #
-    def setupECCounterEntry (self, database, payment_id, invoice_id):
-        if invoice_id != '':
-            self._invoice_id       = database.get ('invoices', invoice_id, 'number')
-            self._invoice_date     = database.get ('invoices', invoice_id, 'date')
-            self._customer_id      = database.get ('invoices', invoice_id, 'client_id')
-            self._item_description = 'Übertrag EC-Karten-Zahlung {}'.format (self._invoice_id)
-            self._remarks          = 'Übertrag EC-Karten-Zahlung'
-        else:
-            self._invoice_id       = None
-            self._invoice_date     = database.get ('payments', payment_id, 'date')
-            self._customer_id      = None
-            self._item_description = 'Übertrag EC-Karten-Zahlung OHNE RECHNUNG (z.B. Mahngebühr)'
-            self._remarks          = 'Übertrag EC-Karten-Zahlung: {}' \
-                                     .format (database.get ('payments', payment_id, 'notes'))
-
-        self._amount           = -1.0 * self._amount
-        self._account_from     = Accounts.EC
-        self._account_to       = Accounts.Main
-        self._payment_type     = 'Umbuchung'
-        self._item_kind        = 'Umbuchung'
+    return entries
 
-    #
-    # Query database for payment entry (shortcut)
-    #
-    def get (self, database, key):
-        return database.get ('payments', self._id, key)
+#
+# Convert frame of DATEV entries into frame of DATEV rows
+#
+# @param entries Entries as created by 'createEntries ()'
+# @return Data frame with all DATEV columns as strings
+#
+def toDatev (entries):
+    rows = pd.DataFrame ('', index=entries.index, columns=range (len (datev_columns)), dtype=object)
 
-    #
-    # Get DATEV output vector column index matching a column id
-    #
-    @staticmethod
-    def getColumn (id):
-        assert id in datev_column_mapping
+    def column (id):
         return datev_column_mapping[id] - 1
 
-    #
-    # Convert entry into vector of DATEV rows
-    #
-    # @return Vector containing all DATEV colunms for this entry
-    #
-    def toDatev (self):
-        row = [''] * len (datev_columns)
-
-        row[self.getColumn ('umsatz')]        = locale.format ("%.2f", abs (self._amount))
-        row[self.getColumn ('soll_haben')]    = 'S' if self._amount < 0 else 'H'
-        row[self.getColumn ('konto')]         = self._account_from
-        row[self.getColumn ('gegenkonto')]    = self._account_to
-
-        if not self._item_tax:
-            row[self.getColumn ('bu_schluessel')] = None
-        elif float (self._item_tax) == 19.0:
-            row[self.getColumn ('bu_schluessel')] = 3
-        elif float (self._item_tax) == 7.0:
-            row[self.getColumn ('bu_schluessel')] = 2
-        elif float (self._item_tax) == 0.0:
-            row[self.getColumn ('bu_schluessel')] = None
-        else:
-            raise "Unknown tax level '{}'".format (self._item_tax)
-
-        row[self.getColumn ('belegdatum')]    = self._payment_date.strftime ('%d%m%Y')
-        row[self.getColumn ('buchungstext')]  = self._item_description
-        row[self.getColumn ('eu_steuersatz')] = self._item_tax
-
-        if self._payment_kind == 'ec':
-            row[self.getColumn ('zahlweise')] = 'EC-Karte'
-        elif self._payment_kind == 'cash':
-            row[self.getColumn ('zahlweise')] = 'Bar'
-        elif self._payment_kind == 'bill':
-            row[self.getColumn ('zahlweise')] = 'Überweisung'
+    def present (values):
+        return values.fillna ('').astype (str) != ''
+
+    rows[column ('umsatz')]     = formatAmount (entries['amount'])
+    rows[column ('soll_haben')] = np.where (entries['amount'] < 0, 'S', 'H')
+    rows[column ('konto')]      = entries['account_from'].astype (str)
+    rows[column ('gegenkonto')] = entries['account_to'].astype (str)
+
+    keys = {}
+    for tax in entries['item_tax'].unique ():
+        if not tax or float (tax) == 0.0:
+            keys[tax] = ''
+        elif float (tax) == 19.0:
+            keys[tax] = '3'
+        elif float (tax) == 7.0:
+            keys[tax] = '2'
         else:
-            raise "Unknown payment type '{}'".format (self._payment_kind)
-
-        row[self.getColumn ('buchungstyp')]        = self._payment_type
-        row[self.getColumn ('gesellschaftername')] = self._responsible
-        row[self.getColumn ('sachverhalt')]        = self._item_kind
+            raise ValueError ("Unknown tax level '{}'".format (tax))
 
-        if self._invoice_id:
-            row[self.getColumn ('beleginfo_art_1')]    = 'Rechnungsnummer'
-            row[self.getColumn ('beleginfo_inhalt_1')] = self._invoice_id
+    rows[column ('bu_schluessel')] = entries['item_tax'].map (keys)
 
-        if self._invoice_date:
-            row[self.getColumn ('beleginfo_art_2')]    = 'Rechnungsdatum'
-            row[self.getColumn ('beleginfo_inhalt_2')] = self._invoice_date
+    rows[column ('belegdatum')]    = entries['payment_date'].dt.strftime ('%d%m%Y')
+    rows[column ('buchungstext')]  = entries['item_description']
+    rows[column ('eu_steuersatz')] = entries['item_tax']
 
-        if self._payment_id:
-            row[self.getColumn ('beleginfo_art_3')]    = 'Vorgangsnummer'
-            row[self.getColumn ('beleginfo_inhalt_3')] = self._payment_id
+    unknown = ~entries['payment_kind'].isin (payment_kinds.keys ())
+    if unknown.any ():
+        raise ValueError ("Unknown payment type '{}'".format (entries['payment_kind'][unknown].iloc[0]))
 
-        if self._item_kind:
-            row[self.getColumn ('beleginfo_art_4')]    = 'Typ'
-            row[self.getColumn ('beleginfo_inhalt_4')] = self._item_kind
+    rows[column ('zahlweise')]          = entries['payment_kind'].map (payment_kinds)
+    rows[column ('buchungstyp')]        = entries['payment_type']
+    rows[column ('gesellschaftername')] = entries['responsible']
+    rows[column ('sachverhalt')]        = entries['item_kind']
 
-        if self._customer_id:
-            row[self.getColumn ('beleginfo_art_5')]    = 'Kundennummer'
-            row[self.getColumn ('beleginfo_inhalt_5')] = self._customer_id
+    item_date = entries['item_date'].dt.strftime ('%d%m%Y')
 
-        if self._remarks:
-            row[self.getColumn ('beleginfo_art_6')]    = 'Bemerkungen'
-            row[self.getColumn ('beleginfo_inhalt_6')] = self._remarks
+    for index, (title, values) in enumerate ([('Rechnungsnummer', entries['invoice_id']),
+                                              ('Rechnungsdatum',  entries['invoice_date']),
+                                              ('Vorgangsnummer',  entries['payment_id']),
+                                              ('Typ',             entries['item_kind']),
+                                              ('Kundennummer',    entries['customer_id']),
+                                              ('Bemerkungen',     entries['remarks']),
+                                              ('Leistungsdatum',  item_date)]):
+        mask = present (values)
+        rows.loc[mask, column ('beleginfo_art_{}'.format (index + 1))]    = title
+        rows.loc[mask, column ('beleginfo_inhalt_{}'.format (index + 1))] = values[mask].astype (str)
 
-        if self._item_date:
-            row[self.getColumn ('beleginfo_art_7')]    = 'Leistungsdatum'
-            row[self.getColumn ('beleginfo_inhalt_7')] = self._item_date.strftime ('%d%m%Y')
-
-        return row
+    return rows
 
 
 #---------------------------------------------------------------------
-# MAIN
+# Export
 #---------------------------------------------------------------------
 
 #
-# Configuration
-#
-# German locale for '1,23' like decimal points
-#
-locale.setlocale (locale.LC_ALL, "de_DE.UTF-8")
-
-#
-# Database instance containg everything which was read
+# Compute DATEV rows, crosscheck rows and totals for a month
 #
-database = Database ()
-
-#
-# Parse command line arguments
+# @param tables Dictionary of all tables
+# @param year   Exported year
+# @param month  Exported month
+# @param debt   Debt buckets as returned by 'computeDebt ()'. If 'None', the
+#               buckets are computed here.
+# @return (DATEV rows, crosscheck rows, turnover, petty cash) tuple
 #
-parser = argparse.ArgumentParser ()
-
-parser.add_argument ('file',               type=str, help='Name of backup ZIP file')
-parser.add_argument ('-m', '--month',      type=int, help='Month (MM)')
-parser.add_argument ('-y', '--year',       type=int, help='Year (YYYY)')
-parser.add_argument ('-o', '--output',     type=str, help='Name of the output file')
-parser.add_argument ('-c', '--crosscheck', type=str, help='Name of the crosscheck file')
-
-args = parser.parse_args ()
-
-filename   = args.file
-month      = args.month
-year       = args.year
-output     = args.output
-crosscheck = args.crosscheck
+def exportMonth (tables, year, month, debt=None):
 
-assert len (filename) > 0
-assert month >= 1 and month <= 12
-assert year >= 2000
-assert len (output) > 0
+    export_month = monthKey (year, month)
 
+    payments = tables['payments'].copy ()
+    payments['order']  = np.arange (len (payments))
+    payments['month']  = payments['date'].dt.year * 12 + payments['date'].dt.month - 1
+    payments['amount'] = roundEuro (payments['amount'])
 
-#
-# Read relevant CSV files from backup ZIP file into database
-#
-with zipfile.ZipFile (filename) as zip:
-    for entry in zip.namelist ():
-
-        if (entry.endswith ('invoices.csv')):
-            with zip.open (entry, 'r') as file:
-                database.add (file, 'invoices')
-        elif (entry.endswith ('invoice_medication.csv')):
-            with zip.open (entry, 'r') as file:
-                database.add (file, 'invoice_medication')
-        elif (entry.endswith ('invoice_product.csv')):
-            with zip.open (entry, 'r') as file:
-                database.add (file, 'invoice_product')
-        elif (entry.endswith ('invoice_service.csv')):
-            with zip.open (entry, 'r') as file:
-                database.add (file, 'invoice_service')
-        elif (entry.endswith ('payments.csv')):
-            with zip.open (entry, 'r') as file:
-                database.add (file, 'payments')
-        elif (entry.endswith ('tax.csv')):
-            with zip.open (entry, 'r') as file:
-                database.add (file, 'tax')
-        elif (entry.endswith ('clients.csv')):
-            with zip.open (entry, 'r') as file:
-                database.add (file, 'clients')
-
-#
-# Generate invoice handling instances
-#
-invoices = {}
+    active  = payments['deleted'] == ''
+    current = payments['month'] == export_month
 
-for invoice_id in database.range ('invoices'):
+    invoices = tables['invoices']
+    invoices = invoices[invoices['status'] == 'complete'].reset_index (drop=True)
 
-    if database.get ('invoices', invoice_id, 'status') == 'complete':
+    if debt is None:
+        debt = computeDebt (tables)
 
-        #
-        # Generate complete invoice information
-        #
-        invoice = Invoice (database, invoice_id)
+    checkTotals (invoices, debt)
 
-        if False:
-            print ("Invoice #" + str (invoice_id) + " (" + invoice._number + "): " + str (invoice._open))
-
-        #
-        # Reduce invoice by payments already performed in previous months
-        #
-        for payment_id in database.range ('payments'):
-
-            #
-            # Use only payments for the processed invoice and skip cancelled payments at all
-            #
-            if not database.get ('payments', payment_id, 'deleted'):
-                payment_invoice_id = database.get ('payments', payment_id, 'invoice_id')
-                if payment_invoice_id and (payment_invoice_id == invoice_id):
-                    date = stringToDate (database.get ('payments', payment_id, 'date'))
-
-                    if (date.year < year) or (date.year == year and date.month < month):
-                        invoice.applyPayment (database, payment_id)
+    #
+    # Payments of the month generating DATEV entries. Accountants tax application
+    # cannot process payments with 0€ amount, cancelled payments are skipped.
+    #
+    processed = payments[current & active & (payments['amount'] != 0)]
+    paid = processed.loc[processed['invoice_id'] != '', 'invoice_id'].unique ()
 
-        if False:
-            print ("  --> " + str (invoice._open))
+    assert pd.Series (paid).isin (invoices['id']).all ()
 
-        invoices[invoice_id] = invoice
+    #
+    # Setup allocation state of the invoices paid in this month and reduce them by
+    # the payments of previous months in chronological order
+    #
+    numbers = invoices.set_index ('id')['number']
+    totals  = invoices.set_index ('id')['total']
 
+    buckets = collections.defaultdict (list)
+    for invoice_id, domain, tax_id, account, sum in \
+            debt.loc[debt['invoice_id'].isin (paid), ['invoice_id', 'domain', 'tax_id', 'account', 'sum']].itertuples (index=False):
+        buckets[invoice_id].append ([domain, tax_id, account, sum])
 
-#
-# Process payment list for the given month to generate DATEV file
-#
-datev = []
+    state = {id: Invoice (numbers[id], totals[id], buckets[id]) for id in paid}
 
-for payment_id in database.range ('payments'):
+    previous = payments[active & (payments['month'] < export_month) & payments['invoice_id'].isin (paid)]
+    previous = previous.sort_values ('date', kind='stable')
 
-    date = stringToDate (database.get ('payments', payment_id, 'date'))
+    for payment_id, invoice_id, amount in previous[['id', 'invoice_id', 'amount']].itertuples (index=False):
+        state[invoice_id].applyPayment (payment_id, amount)
 
     #
-    # Given month only
+    # Case 1: Invoice based payments, one entry per paid invoice part
     #
-    if date.year == year and date.month == month:
-
-        #
-        # Accountants tax application cannot process payments with 0€ amount
-        #
-        if roundEuro (float (database.get ('payments', payment_id, 'amount'))) != 0:
-
-            #
-            # Skip cancelled payments
-            #
-            if not database.get ('payments', payment_id, 'deleted'):
-
-                invoice_id = database.get ('payments', payment_id, 'invoice_id')
-
-                #
-                # Case 1: Invoice based payment
-                #
-                if invoice_id:
-                    assert invoice_id in invoices
-
-                    #
-                    # The invoice debt is reduced by the payment just made. The paid parts
-                    # are returned in this process and will be used to generate a single
-                    # DATEV entry for each part.
-                    #
-                    parts = invoices[invoice_id].applyPayment (database, payment_id)
-
-                    for part in parts:
-                        entry = DatevEntry (database, payment_id)
-                        entry.setupInvoiceEntry (database, invoice_id, part)
-                        datev.append (entry)
-
-                #
-                # Case 2: Non-invoice based payment
-                #
-                else:
-                    entry = DatevEntry (database, payment_id)
-                    entry.setupNonInvoiceEntry ()
-                    datev.append (entry)
-
-                #
-                # In case of EC card payments, setup additional counter entry. Exception exists, like
-                # 'Mahngebuehren' which have to be entered manually and separately without having an
-                # invoice.
-                #
-                if database.get ('payments', payment_id, 'method') == 'ec':
-                    entry = DatevEntry (database, payment_id)
-                    entry.setupECCounterEntry (database, payment_id, invoice_id)
-                    datev.append (entry)
+    parts = []
+    for order, payment_id, invoice_id, amount in \
+            processed.loc[processed['invoice_id'] != '', ['order', 'id', 'invoice_id', 'amount']].itertuples (index=False):
+        for sub, part in enumerate (state[invoice_id].applyPayment (payment_id, amount)):
+            parts.append ((order, sub) + part)
 
+    parts = pd.DataFrame (parts, columns=['order', 'sub', 'domain', 'tax_id', 'account', 'sum'])
 
-#
-# Extract result as DATEV file
-#
-csv.register_dialect ('datev',
-                      delimiter=';',
-                      quoting=csv.QUOTE_ALL,
-                      quotechar='"')
-
-with open (output, 'w', newline='') as file:
-    writer = csv.writer (file, dialect='datev')
+    info = invoices.set_index ('id')[['number', 'date', 'client_id']]
+    taxes = tables['tax'].set_index ('id')['tax']
 
-    writer.writerow (datev_columns)
+    source = processed.set_index ('order').loc[parts['order']].reset_index ()
+    source.index = parts.index
+    invoice = info.loc[source['invoice_id']].set_index (parts.index)
 
-    for entry in datev:
-        writer.writerow (entry.toDatev ())
+    invoice_entries = createEntries (source,
+                                     sub              = parts['sub'],
+                                     invoice_id       = invoice['number'],
+                                     invoice_date     = invoice['date'],
+                                     customer_id      = invoice['client_id'],
+                                     item_tax         = parts['tax_id'].map (taxes),
+                                     item_kind        = parts['domain'].map (line_item_kinds),
+                                     item_description = 'Rechnung ' + invoice['number'],
+                                     amount           = parts['sum'],
+                                     payment_type     = 'Umsatz',
+                                     account_from     = parts['account'],
+                                     account_to       = np.where (source['method'] == 'bill',
+                                                                  Accounts.Transfer, Accounts.Main))
 
-#
-# Generate crosscheck table if requested
-#
-if crosscheck is not None:
+    #
+    # Case 2: Non-invoice based payments
+    #
+    other = processed[processed['invoice_id'] == '']
+    bank  = other['paymenttype'].str.lower ().str.startswith ('geld auf bank')
 
-    ec_payments = []
-    bill_payments = []
+    other_entries = createEntries (other,
+                                   account_from     = np.where (bank, Accounts.Bank, Accounts.Null),
+                                   account_to       = Accounts.Main,
+                                   payment_type     = np.where (bank, 'Umbuchung', 'Barentnahme'),
+                                   item_kind        = np.where (bank, 'Einzahlung', 'Barausgabe'),
+                                   item_description = other['notes'].where (~bank, 'Geld auf Bank'),
+                                   remarks          = other['paymenttype'].where (~bank, ''))
 
-    for payment_id in database.range ('payments'):
+    #
+    # In case of EC card payments, setup additional counter entry. Exception exists, like
+    # 'Mahngebuehren' which have to be entered manually and separately without having an
+    # invoice.
+    #
+    ec = processed[processed['method'] == 'ec']
+    with_invoice = ec['invoice_id'] != ''
+    invoice = info.reindex (ec['invoice_id']).set_index (ec.index)
 
-        #
-        # Use only payments for the processed invoice and skip cancelled payments at all
-        #
-        if not database.get ('payments', payment_id, 'deleted'):
-            amount = roundEuro (float (database.get ('payments', payment_id, 'amount')))
-            date = stringToDate (database.get ('payments', payment_id, 'date'))
-            method = database.get ('payments', payment_id, 'method')
+    ec_entries = createEntries (ec,
+                                sub              = 1 << 30,
+                                invoice_id       = invoice['number'].where (with_invoice, ''),
+                                invoice_date     = invoice['date'].where (with_invoice,
+                                                                          ec['date'].dt.strftime ('%Y-%m-%d %H:%M:%S')),
+                                customer_id      = invoice['client_id'].where (with_invoice, ''),
+                                item_description = ('Übertrag EC-Karten-Zahlung ' + invoice['number'].fillna ('')).where (
+                                                       with_invoice, 'Übertrag EC-Karten-Zahlung OHNE RECHNUNG (z.B. Mahngebühr)'),
+                                remarks          = pd.Series ('Übertrag EC-Karten-Zahlung', index=ec.index).where (
+                                                       with_invoice, 'Übertrag EC-Karten-Zahlung: ' + ec['notes']),
+                                amount           = -1.0 * ec['amount'],
+                                account_from     = Accounts.EC,
+                                account_to       = Accounts.Main,
+                                payment_type     = 'Umbuchung',
+                                item_kind        = 'Umbuchung')
 
-            if date.year == year and date.month == month:
+    frames = [frame for frame in [invoice_entries, other_entries, ec_entries] if len (frame) > 0]
+    entries = pd.concat (frames, ignore_index=True) if frames else createEntries (processed.iloc[:0])
+    entries = entries.sort_values (['order', 'sub'], kind='stable').reset_index (drop=True)
 
-                amount = locale.format ('%.2f', abs (amount))
-                date = date.strftime ('%d-%m-%Y')
-                bill_number = None
-                name = None
+    #
+    # Crosscheck rows for EC card and bank transfer payments of the month
+    #
+    checked = payments[current & active & payments['method'].isin (['ec', 'bill'])]
+    invoice = info.reindex (checked['invoice_id']).set_index (checked.index)
+    clients = tables['clients'].set_index ('id')['lastname'] if 'clients' in tables else pd.Series (dtype=object)
 
+    crosscheck = pd.DataFrame ({
+        'Datum'          : checked['date'].dt.strftime ('%d-%m-%Y'),
+        'Betrag'         : formatAmount (checked['amount']),
+        'Zahlweise'      : checked['method'].map ({'ec': 'EC Karte', 'bill': 'Überweisung'}),
+        'Rechnungsnummer': invoice['number'].fillna (''),
+        'Name'           : invoice['client_id'].map (clients).fillna (''),
+        'method'         : checked['method'].map ({'ec': 0, 'bill': 1})
+    })
 
-                invoice_id = database.get ('payments', payment_id, 'invoice_id')
-                if invoice_id:
-                    bill_number = database.get ('invoices', invoice_id, 'number')
-                    client_id = database.get ('invoices', invoice_id, 'client_id')
+    crosscheck = crosscheck.sort_values ('Datum', kind='stable').sort_values ('method', kind='stable')
+    crosscheck = crosscheck.drop (columns='method')
 
-                    if client_id:
-                        name = database.get ('clients', client_id, 'lastname')
+    #
+    # Turnover of the month and petty cash up to the end of the month
+    #
+    turnover   = payments.loc[active & current & (payments['invoice_id'] != ''), 'amount'].sum ()
+    petty_cash = payments.loc[active & (payments['month'] <= export_month) & (payments['method'] == 'cash'), 'amount'].sum ()
 
-                if method == 'ec':
-                    ec_payments.append ([date, amount, 'EC Karte', bill_number, name])
-                elif method == 'bill':
-                    bill_payments.append ([date, amount, 'Überweisung', bill_number, name])
+    return toDatev (entries), crosscheck, turnover, petty_cash
 
-    ec_payments.sort (key=lambda row: row[0])
-    bill_payments.sort (key=lambda row: row[0])
 
-    with open (crosscheck, 'w', newline='') as file:
-        writer = csv.writer (file, dialect='datev')
+#---------------------------------------------------------------------
+# MAIN
+#---------------------------------------------------------------------
 
-        writer.writerow (['Datum', 'Betrag', 'Zahlweise', 'Rechnungsnummer', 'Name'])
+def main ():
 
-        for payment in ec_payments:
-            writer.writerow (payment)
+    #
+    # Parse command line arguments
+    #
+    parser = argparse.ArgumentParser ()
 
-        for payment in bill_payments:
-            writer.writerow (payment)
+    parser.add_argument ('file',               type=str, help='Name of backup ZIP file')
+    parser.add_argument ('-m', '--month',      type=int, help='Month (MM)')
+    parser.add_argument ('-y', '--year',       type=int, help='Year (YYYY)')
+    parser.add_argument ('-o', '--output',     type=str, help='Name of the output file')
+    parser.add_argument ('-c', '--crosscheck', type=str, help='Name of the crosscheck file')
 
+    args = parser.parse_args ()
 
+    assert len (args.file) > 0
+    assert args.month >= 1 and args.month <= 12
+    assert args.year >= 2000
+    assert len (args.output) > 0
 
-#
-# Generate some additional information
-#
-petty_cash = 0.0
-turnover   = 0.0
+    tables = loadBackup (args.file)
 
-for payment_id in database.range ('payments'):
+    rows, crosscheck, turnover, petty_cash = exportMonth (tables, args.year, args.month)
 
-    if not database.get ('payments', payment_id, 'deleted'):
-        amount = roundEuro (float (database.get ('payments', payment_id, 'amount')))
-        date = stringToDate (database.get ('payments', payment_id, 'date'))
+    #
+    # Extract result as DATEV file
+    #
+    with open (args.output, 'w', newline='') as file:
+        rows.to_csv (file, sep=';', quoting=csv.QUOTE_ALL, quotechar='"', header=datev_columns,
+                     index=False, lineterminator='\r\n')
 
+    #
+    # Generate crosscheck table if requested
+    #
+    if args.crosscheck is not None:
+        with open (args.crosscheck, 'w', newline='') as file:
+            crosscheck.to_csv (file, sep=';', quoting=csv.QUOTE_ALL, quotechar='"',
+                               index=False, lineterminator='\r\n')
 
-        #
-        # Petty cash
-        #
-        if database.get ('payments', payment_id, 'method') == 'cash':
-            if (date.year < year) or (date.year == year and date.month <= month):
-                petty_cash += amount
+    print ('Umsatz  : {:.2f} Euro'.format (turnover))
+    print ('Barkasse: {:.2f} Euro'.format (petty_cash))
 
-        #
-        # Turnover
-        #
-        if database.get ('payments', payment_id, 'invoice_id'):
-            if date.year == year and date.month == month:
-                turnover += amount
 
-print ('Umsatz  : {:.2f} Euro'.format (turnover))
-print ('Barkasse: {:.2f} Euro'.format (petty_cash))
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------------------------
+# datevserver.py - Serve DATEV exports of InBehandlung backup files from memory via HTTP
+#
+# Syntax: datevserver.py [-p <port>] [-r <backup directory>] [-n <number of cached backups>]
+#
+# Requests:
+#
+#   GET /export?backup=<file>&year=<YYYY>&month=<MM>     - DATEV file of a month
+#   GET /crosscheck?backup=<file>&year=<YYYY>&month=<MM> - Crosscheck file of a month
+#   GET /totals?backup=<file>&year=<YYYY>&month=<MM>     - Turnover and petty cash as JSON
+#
+# License: MIT License
+#-------------------------------------------------------------------------------------------------
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Frank Blankenburg
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial
+# portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#-------------------------------------------------------------------------------------------------
+
+import argparse
+import collections
+import concurrent.futures
+import csv
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import threading
+import urllib.parse
+
+import datevexport
+
+
+#---------------------------------------------------------------------
+# CLASS Backup
+#
+# This class keeps the database of a single backup file together with
+# the results derived from it
+#---------------------------------------------------------------------
+
+class Backup:
+
+    #
+    # Constructor
+    #
+    # @param database Database containing the backup content
+    #
+    def __init__ (self, database):
+        self.database = database
+
+        self._totals = None
+        self._lock = threading.Lock ()
+
+    #
+    # Return monthly totals of the backup, computed on first use
+    #
+    def totals (self):
+        with self._lock:
+            if self._totals is None:
+                self._totals = datevexport.Totals (self.database)
+
+            return self._totals
+
+
+#---------------------------------------------------------------------
+# CLASS BackupCache
+#
+# This class keeps the databases of the most recently used backup files
+# in memory
+#---------------------------------------------------------------------
+
+class BackupCache:
+
+    #
+    # Constructor
+    #
+    # @param capacity Maximum number of databases kept in memory
+    # @param jobs     Number of worker processes reading the tables of a backup. The
+    #                 workers are spawned, because forking the threaded server is unsafe.
+    #
+    def __init__ (self, capacity, jobs):
+        self._capacity = capacity
+        self._jobs = jobs
+        self._context = multiprocessing.get_context ('spawn')
+        self._lock = threading.Lock ()
+
+        #
+        # Cache content in least recently used order ((path, mtime, size), future of the backup)
+        #
+        self._entries = collections.OrderedDict ()
+
+    #
+    # Return loaded backup file
+    #
+    # The backup is identified by its path, modification time and size, so a
+    # replaced backup file is read again. Concurrent requests for a backup which
+    # is currently read wait for that single load.
+    #
+    # @param filename Name of the backup ZIP file
+    # @return Backup containing the database of the file
+    #
+    def get (self, filename):
+        status = os.stat (filename)
+        key = (os.path.realpath (filename), status.st_mtime_ns, status.st_size)
+
+        with self._lock:
+            future = self._entries.get (key)
+            owner = future is None
+
+            if owner:
+                future = concurrent.futures.Future ()
+                self._entries[key] = future
+
+                while len (self._entries) > self._capacity:
+                    self._entries.popitem (last=False)
+            else:
+                self._entries.move_to_end (key)
+
+        if owner:
+            try:
+                future.set_result (Backup (datevexport.loadBackup (filename, self._jobs, self._context)))
+            except BaseException as exception:
+                future.set_exception (exception)
+
+                with self._lock:
+                    if self._entries.get (key) is future:
+                        del self._entries[key]
+
+        return future.result ()
+
+
+#---------------------------------------------------------------------
+# CLASS RequestHandler
+#---------------------------------------------------------------------
+
+#
+# HTTP request handler answering export requests from the backup cache
+#
+class RequestHandler (http.server.BaseHTTPRequestHandler):
+
+    #
+    # Answer GET request
+    #
+    def do_GET (self):
+        url = urllib.parse.urlparse (self.path)
+        query = urllib.parse.parse_qs (url.query)
+
+        try:
+            filename = self.server.backupPath (query['backup'][0])
+            year = int (query['year'][0])
+            month = int (query['month'][0])
+
+            assert month >= 1 and month <= 12
+            assert year >= 2000
+        except (KeyError, ValueError, AssertionError):
+            self.send_error (400, 'Parameters backup, year and month required')
+            return
+
+        if filename is None or not os.path.isfile (filename):
+            self.send_error (404, 'Backup not found')
+            return
+
+        try:
+            backup = self.server.cache.get (filename)
+            database = backup.database
+
+            if url.path == '/export':
+                self.sendRows (datevexport.datev_columns, datevexport.exportMonth (database, year, month))
+            elif url.path == '/crosscheck':
+                self.sendRows (['Datum', 'Betrag', 'Zahlweise', 'Rechnungsnummer', 'Name'],
+                               datevexport.crosscheckMonth (database, year, month))
+            elif url.path == '/totals':
+                totals = backup.totals ()
+                month = datevexport.monthKey (year, month)
+                self.sendContent ('application/json',
+                                  json.dumps ({'turnover': totals.turnover (month) / 100.0,
+                                               'petty_cash': totals.pettyCash (month + 1) / 100.0}))
+            else:
+                self.send_error (404, 'Unknown request')
+
+        except Exception as exception:
+            self.send_error (500, str (exception))
+
+    #
+    # Send rows as DATEV CSV file
+    #
+    def sendRows (self, header, rows):
+        content = io.StringIO (newline='')
+        writer = csv.writer (content, dialect='datev')
+
+        writer.writerow (header)
+        writer.writerows (rows)
+
+        self.sendContent ('text/csv; charset=utf-8', content.getvalue ())
+
+    #
+    # Send response content
+    #
+    def sendContent (self, type, content):
+        data = content.encode ('utf-8')
+
+        self.send_response (200)
+        self.send_header ('Content-Type', type)
+        self.send_header ('Content-Length', str (len (data)))
+        self.end_headers ()
+        self.wfile.write (data)
+
+
+#---------------------------------------------------------------------
+# CLASS Server
+#---------------------------------------------------------------------
+
+#
+# Threaded HTTP server owning the backup cache
+#
+class Server (http.server.ThreadingHTTPServer):
+
+    #
+    # Constructor
+    #
+    # @param address Server (host, port) address
+    # @param cache   Backup cache serving the requests
+    # @param root    Directory the requested backup files must be located in
+    #
+    def __init__ (self, address, cache, root):
+        super ().__init__ (address, RequestHandler)
+        self.cache = cache
+        self._root = os.path.realpath (root)
+
+    #
+    # Map requested backup name to file path
+    #
+    # @param name Backup file name relative to the backup directory
+    # @return Path of the backup file or 'None' if the name points outside of the directory
+    #
+    def backupPath (self, name):
+        path = os.path.realpath (os.path.join (self._root, name))
+        return path if os.path.commonpath ([self._root, path]) == self._root else None
+
+
+#---------------------------------------------------------------------
+# MAIN
+#---------------------------------------------------------------------
+
+def main ():
+
+    #
+    # Parse command line arguments
+    #
+    parser = argparse.ArgumentParser ()
+
+    parser.add_argument ('-a', '--address', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument ('-p', '--port',    type=int, default=8080,        help='Port to listen on')
+    parser.add_argument ('-r', '--root',    type=str, default='.',         help='Directory containing the backup files')
+    parser.add_argument ('-n', '--cache',   type=int, default=4,           help='Number of backups kept in memory')
+    parser.add_argument ('-j', '--jobs',    type=int, default=1,
+                         help='Number of processes reading the backup tables concurrently')
+
+    args = parser.parse_args ()
+
+    assert args.cache >= 1
+
+    server = Server ((args.address, args.port), BackupCache (args.cache, args.jobs), args.root)
+
+    print ('Serving backups in {} on {}:{}'.format (os.path.realpath (args.root), args.address, args.port))
+
+    try:
+        server.serve_forever ()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close ()
+
+
+if __name__ == '__main__':
+    main ()